@@ -3,3 +3,19 @@ from __future__ import unicode_literals
 
 __version__ = '0.0.1'
 
+
+def _stock_apps_importable():
+	try:
+		import frappe, erpnext
+	except ImportError:
+		# e.g. while the app itself is being packaged
+		return False
+	return True
+
+
+# install oi_custom's method overrides as soon as a process imports the app. Only a missing frappe or
+# erpnext is tolerated here; any other failure to install an override is a bug and must surface.
+if _stock_apps_importable():
+	from oi_custom.customizations.overrides import apply_overrides
+	apply_overrides()
+
@@ -0,0 +1,18 @@
+// Copyright (c) 2019, the Open Institute for Social Science and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Payroll Batch Run', {
+	refresh: function(frm) {
+		if (!frm.is_new() && (!in_list(["Queued", "Running"], frm.doc.status)
+			|| (frm.doc.__onload || {}).has_stale_items)) {
+			frm.add_custom_button(__("Run"), function() {
+				frappe.call({
+					method: 'run_batch',
+					args: {},
+					callback: function() { frm.reload_doc(); },
+					doc: frm.doc
+				});
+			});
+		}
+	}
+});
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+from frappe import _
+from frappe.utils import cint, getdate, now
+
+from oi_custom.customizations.payroll.batch import enqueue_batch_run, is_batch_item_stale, reset_stale_batch_items
+
+class PayrollBatchRun(Document):
+	"""
+		creates, drafts and (optionally) submits one Payroll Voucher per row, each in its own background job;
+		see oi_custom.customizations.payroll.batch
+	"""
+	def onload(self):
+		# a batch left running by a dead job can be run again
+		self.set_onload("has_stale_items", any(is_batch_item_stale(item) for item in self.items))
+
+	def validate(self):
+		if cint(self.max_concurrent_writes) < 1:
+			frappe.throw(_("Max Concurrent Writes must be at least 1"))
+
+		specs = set()
+		for item in self.items:
+			if getdate(item.end_date) < getdate(item.start_date):
+				frappe.throw(_("Row {0}: End Date cannot be before Start Date").format(item.idx))
+
+			spec = (item.company, item.branch, item.payroll_frequency, getdate(item.start_date), getdate(item.end_date))
+			if spec in specs:
+				frappe.throw(_("Row {0}: the same voucher is listed twice").format(item.idx))
+			specs.add(spec)
+
+	def run_batch(self):
+		"""
+			queue every row that has not produced a voucher yet; rows that completed are left alone, so a batch
+			with failures can simply be run again. Rows whose job died while running them count as failed.
+		"""
+		self.check_permission("write")
+		reset_stale_batch_items(self)
+		if self.status in ("Queued", "Running") and any(item.status in ("Queued", "Running") for item in self.items):
+			frappe.throw(_("{0} is already running").format(self.name))
+		if all(item.status == "Completed" for item in self.items):
+			frappe.throw(_("Every Payroll Voucher of {0} has already been processed").format(self.name))
+
+		self.update({"status": "Queued", "started": now(), "finished": None, "summary": None})
+		for item in self.items:
+			if item.status != "Completed":
+				item.update({"status": "Queued", "error": None, "seconds": None, "started": None})
+		self.save()
+
+		enqueue_batch_run(self)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+
+from oi_custom.customizations.payroll.batch import get_batch_run_summary
+
+class TestPayrollBatchRun(unittest.TestCase):
+	def test_summary_counts_timings_and_failures(self):
+		items = [
+			frappe._dict(idx=1, company="_Test Company", branch="North", payroll_frequency="Monthly",
+				start_date="2019-08-01", end_date="2019-08-31", payroll_voucher="Payroll-Voucher 0001",
+				status="Completed", seconds=12.5, salary_slips=40),
+			frappe._dict(idx=2, company="_Test Company", branch="South", payroll_frequency="Monthly",
+				start_date="2019-08-01", end_date="2019-08-31", payroll_voucher="Payroll-Voucher 0002",
+				status="Failed", seconds=3, salary_slips=0,
+				error="Traceback (most recent call last):\n  ...\nValidationError: Cost Center is mandatory\n")
+		]
+		summary = get_batch_run_summary(items, 13)
+
+		self.assertEqual(summary["completed_vouchers"], 1)
+		self.assertEqual(summary["failed_vouchers"], 1)
+		self.assertEqual(summary["salary_slips"], 40)
+		self.assertEqual(summary["voucher_seconds"], 15.5)
+		self.assertEqual(summary["slowest"], "Payroll-Voucher 0001")
+		self.assertEqual(summary["rows"][1]["error"], "ValidationError: Cost Center is mandatory")
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+from frappe import _
+from frappe.utils import cint, flt
+
+class PayrollDispatchSettings(Document):
+	"""
+		how oi_custom.customizations.payroll.dispatch decides between running a payroll job inline and in the
+		background, and on which queue and how many workers
+	"""
+	def validate(self):
+		if not 0 < flt(self.timing_weight) <= 1:
+			frappe.throw(_("Weight of the Latest Timing must be more than 0 and at most 1"))
+		if cint(self.max_workers) < 1:
+			frappe.throw(_("Max Workers per Submission must be at least 1"))
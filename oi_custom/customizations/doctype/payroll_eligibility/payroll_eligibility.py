@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+
+class PayrollEligibility(Document):
+	"""
+		one row per submitted Salary Structure Assignment, named after it, with what a Payroll Voucher filters
+		employees on; maintained by oi_custom.customizations.payroll.eligibility
+	"""
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Payroll Eligibility", ["company", "effective_from"])
@@ -0,0 +1,8 @@
+// Copyright (c) 2019, the Open Institute for Social Science and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Payroll Slip Timing', {
+	refresh: function(frm) {
+
+	}
+});
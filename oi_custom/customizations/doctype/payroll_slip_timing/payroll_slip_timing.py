@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+
+class PayrollSlipTiming(Document):
+	"""
+		how long creating or submitting one salary slip of a structure and frequency takes; kept up to date by
+		oi_custom.customizations.payroll.dispatch and read when deciding whether to run a job inline
+	"""
+	pass
+
+
+def on_doctype_update():
+	# one row per structure, frequency and operation
+	frappe.db.add_unique("Payroll Slip Timing", ["salary_structure", "payroll_frequency", "operation"],
+		constraint_name="unique_slip_timing")
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+
+from oi_custom.customizations.payroll.dispatch import record_slip_timings, plan_dispatch, get_dispatch_settings
+
+class TestPayrollSlipTiming(unittest.TestCase):
+	def tearDown(self):
+		frappe.db.sql("""delete from `tabPayroll Slip Timing` where salary_structure like '_Test Dispatch%%'""")
+
+	def test_timings_are_averaged_and_drive_dispatch(self):
+		weight = get_dispatch_settings().timing_weight
+		record_slip_timings("Submit", "Monthly", {"_Test Dispatch Slow": (10, 20), "_Test Dispatch Fast": (10, 0.1)})
+		record_slip_timings("Submit", "Monthly", {"_Test Dispatch Slow": (10, 40)})
+
+		slow = frappe.db.get_value("Payroll Slip Timing", {"salary_structure": "_Test Dispatch Slow"},
+			["seconds_per_slip", "samples"], as_dict=True)
+		self.assertAlmostEqual(slow.seconds_per_slip, weight * 4 + (1 - weight) * 2, places=4)
+		self.assertEqual(slow.samples, 20)
+
+		self.assertTrue(plan_dispatch("Submit", "Monthly", {"_Test Dispatch Fast": 100}).inline)
+		self.assertFalse(plan_dispatch("Submit", "Monthly", {"_Test Dispatch Slow": 100}).inline)
@@ -3,6 +3,20 @@
 
 frappe.ui.form.on('Payroll Voucher', {
 	onload: function (frm) {
+		frappe.realtime.off(PAYROLL_JOB_PROGRESS_EVENT);
+		frappe.realtime.on(PAYROLL_JOB_PROGRESS_EVENT, function(job) {
+			if (cur_frm && cur_frm.doctype == 'Payroll Voucher' && cur_frm.doc.name == job.payroll_voucher) {
+				show_payroll_job_progress(cur_frm, job);
+			}
+		});
+		// published by the job after its last commit, so the reload sees all it did
+		frappe.realtime.off(PAYROLL_JOB_FINISHED_EVENT);
+		frappe.realtime.on(PAYROLL_JOB_FINISHED_EVENT, function(job) {
+			if (cur_frm && cur_frm.doctype == 'Payroll Voucher' && cur_frm.doc.name == job.payroll_voucher) {
+				cur_frm.reload_doc();
+			}
+		});
+
 		if (!frm.doc.posting_date) {
 			frm.doc.posting_date = frappe.datetime.nowdate();
 		}
@@ -10,7 +24,55 @@ frappe.ui.form.on('Payroll Voucher', {
 		frm.toggle_reqd(['payroll_frequency'], !frm.doc.salary_slip_based_on_timesheet);
 	},
 	refresh: function(frm) {
+		frm.salary_slip_totals = null;
+		frm.events.render_salary_slip_pager(frm);
+		if (!frm.is_new()) {
+			frm.add_custom_button(__("Run Logs"), function() {
+				frappe.set_route("List", "Payroll Voucher Run Log", {payroll_voucher: frm.doc.name});
+			}, __("View"));
+			frm.add_custom_button(__("Salary Slip Emails"), function() {
+				frappe.set_route("List", "Salary Slip Email", {payroll_voucher: frm.doc.name});
+			}, __("View"));
+			frm.events.attach_payroll_jobs(frm);
+		}
+	},
+	attach_payroll_jobs: function(frm) {
+		// show the progress of jobs still at work, and offer to resume the ones that stopped
+		frappe.call({
+			method: 'oi_custom.customizations.payroll.progress.get_payroll_jobs',
+			args: {payroll_voucher: frm.doc.name},
+			callback: function(r) {
+				if (!r.message) return;
+
+				r.message.running.forEach(function(job) {
+					show_payroll_job_progress(frm, job);
+				});
 
+				let resumable = r.message.resumable;
+				if (frm.doc.docstatus == 1 && !frm.doc.salary_slips_submitted && resumable["Submit Salary Slips"]) {
+					frm.add_custom_button(__("Resume Salary Slip Submission"), function() {
+						frappe.call({
+							method: 'resume_salary_slip_submission',
+							args: {},
+							callback: function() { frm.reload_doc(); },
+							doc: frm.doc,
+							freeze: true,
+							freeze_message: 'Submitting remaining salary slips...'
+						});
+					});
+				}
+				if (frm.doc.docstatus == 2 && resumable["Cancel Salary Slips"]) {
+					frm.add_custom_button(__("Resume Salary Slip Cancellation"), function() {
+						frappe.call({
+							method: 'resume_salary_slip_cancellation',
+							args: {},
+							callback: function() { frm.reload_doc(); },
+							doc: frm.doc
+						});
+					});
+				}
+			}
+		});
 	},
 	onsubmit: function(frm) {
 		frm.refresh_field('salary_slips');
@@ -20,7 +82,8 @@ frappe.ui.form.on('Payroll Voucher', {
 		frappe.call({
 			method: 'create_salary_slips',
 			args: {},
-			callback: function() {frm.refresh_field('salary_slips'); console.log(frm)},
+			// large runs continue in the background; refreshing picks up their progress
+			callback: function() { frm.refresh(); },
 			doc: frm.doc,
 			freeze:true,
 			freeze_message: 'Drafting new salary slips...'
@@ -169,17 +232,26 @@ frappe.ui.form.on('Payroll Voucher', {
 	},
 
 	find_relevant_employees: function (frm) {
-		if (frm.doc.company && frm.doc.start_date && frm.doc.end_date) {
-			frappe.call({
-				method: 'populate_salary_slip_table',
-				args: {},
-				callback: function() { frm.refresh_field('salary_slips'); },
-				doc: frm.doc,
-				freeze:true,
-				freeze_message: 'Finding employees for these criteria...'
-			})
+		if (frm.doc.docstatus == 0 && frm.doc.company && frm.doc.start_date && frm.doc.end_date) {
+			find_relevant_employees(frm);
 		}
+	},
+
+	render_salary_slip_pager: function (frm, start) {
+		// large vouchers arrive without their salary slip rows; show those a page at a time instead of the grid
+		const paged = frm.doc.salary_slips_paged && !(frm.doc.salary_slips || []).length;
+		frm.toggle_display('salary_slips', !paged);
+		frm.toggle_display('salary_slips_pager', paged);
+		if (!paged) return;
 
+		frm.salary_slip_page_start = start || 0;
+		frappe.call({
+			method: 'oi_custom.customizations.payroll.paging.get_salary_slip_page',
+			args: {payroll_voucher: frm.doc.name, start: frm.salary_slip_page_start},
+			callback: function(r) {
+				render_salary_slip_page(frm, r.message || []);
+			}
+		});
 	},
 
 	set_start_end_dates: function (frm) {
@@ -218,6 +290,126 @@ frappe.ui.form.on('Payroll Voucher', {
 });
 
 
+// editing several filters in a row triggers a single lookup, once the user has paused for a moment
+const find_relevant_employees = frappe.utils.debounce(function (frm) {
+	const filters = {};
+	["company", "payroll_frequency", "start_date", "end_date", "salary_slip_based_on_timesheet",
+		"branch", "department", "designation"].forEach(function (f) { filters[f] = frm.doc[f]; });
+
+	// only the answer to the latest lookup is applied
+	const lookup = frm.employee_lookup = (frm.employee_lookup || 0) + 1;
+	frappe.call({
+		method: 'oi_custom.customizations.payroll.discovery.find_relevant_employees',
+		args: {filters: filters, payroll_voucher: frm.doc.__islocal ? null : frm.doc.name},
+		callback: function(r) {
+			if (lookup != frm.employee_lookup) return;
+
+			frm.clear_table('salary_slips');
+			(r.message || []).forEach(function (d) {
+				$.extend(frm.add_child('salary_slips'), d);
+			});
+			// the table now holds every row again
+			frm.doc.salary_slips_paged = 0;
+			frm.refresh_field('salary_slips');
+			frm.events.render_salary_slip_pager(frm);
+		},
+		freeze: true,
+		freeze_message: 'Finding employees for these criteria...'
+	});
+}, 500);
+
+
+const SALARY_SLIP_PAGE_LENGTH = 100;
+
+const render_salary_slip_page = function (frm, rows) {
+	const totals = frm.salary_slip_totals || (frm.doc.__onload || {}).salary_slip_totals || {};
+	const start = frm.salary_slip_page_start;
+	const editable = frm.doc.docstatus == 0;
+	const escape = frappe.utils.escape_html;
+
+	const $wrapper = $(frm.fields_dict.salary_slips_pager.wrapper).empty();
+	$(`<p class="text-muted">${__("{0} employees, {1} salary slips ({2} submitted), net pay {3}", [
+		totals.total_rows || 0, totals.salary_slips || 0, totals.submitted_salary_slips || 0,
+		format_currency(totals.net_pay || 0)])}</p>`).appendTo($wrapper);
+
+	const $table = $(`<table class="table table-bordered table-condensed">
+		<thead><tr><th>#</th><th>${__("Employee")}</th><th>${__("Employee Name")}</th>
+			<th>${__("Salary Slip")}</th><th class="text-right">${__("Net Pay")}</th><th></th></tr></thead>
+		<tbody></tbody></table>`).appendTo($wrapper);
+	rows.forEach(function (d) {
+		const salary_slip_link = d.salary_slip ?
+			`<a href="#Form/Salary Slip/${escape(encodeURIComponent(d.salary_slip))}">${escape(d.salary_slip)}</a>` : "";
+		const $row = $(`<tr><td>${cint(d.idx)}</td><td>${escape(d.employee)}</td><td>${escape(d.employee_name)}</td>
+			<td>${salary_slip_link}</td>
+			<td class="text-right">${d.salary_slip ? format_currency(d.net_pay) : ""}</td><td></td></tr>`)
+			.appendTo($table.find("tbody"));
+		if (editable) {
+			$(`<a>${__("Edit")}</a>`).appendTo($row.find("td:last")).on("click", function () {
+				edit_salary_slip_row(frm, d);
+			});
+			$row.find("td:last").append(" | ");
+			$(`<a>${__("Remove")}</a>`).appendTo($row.find("td:last")).on("click", function () {
+				update_salary_slip_rows(frm, {deleted: [d.name]});
+			});
+		}
+	});
+	if (editable) {
+		$(`<button class="btn btn-default btn-xs">${__("Add Row")}</button>`).appendTo($wrapper)
+			.on("click", function () {
+				edit_salary_slip_row(frm);
+			});
+	}
+
+	const $pager = $(`<div class="btn-group">
+		<button class="btn btn-default btn-xs prev">${__("Previous")}</button>
+		<button class="btn btn-default btn-xs next">${__("Next")}</button></div>`).appendTo($wrapper);
+	$pager.find(".prev").prop("disabled", start == 0).on("click", function () {
+		frm.events.render_salary_slip_pager(frm, Math.max(start - SALARY_SLIP_PAGE_LENGTH, 0));
+	});
+	$pager.find(".next").prop("disabled", start + SALARY_SLIP_PAGE_LENGTH >= (totals.total_rows || 0))
+		.on("click", function () {
+			frm.events.render_salary_slip_pager(frm, start + SALARY_SLIP_PAGE_LENGTH);
+		});
+};
+
+// adds a row to a paged table, or changes the employee and salary slip of an existing one
+const edit_salary_slip_row = function (frm, row) {
+	const dialog = new frappe.ui.Dialog({
+		title: row ? __("Edit Row {0}", [row.idx]) : __("Add Row"),
+		fields: [
+			{fieldname: "employee", fieldtype: "Link", options: "Employee", label: __("Employee"), reqd: 1,
+				"default": row ? row.employee : null},
+			{fieldname: "salary_slip", fieldtype: "Link", options: "Salary Slip", label: __("Salary Slip"),
+				"default": row ? row.salary_slip : null,
+				get_query: function () {
+					return {filters: {employee: dialog.get_value("employee"), start_date: frm.doc.start_date,
+						end_date: frm.doc.end_date, docstatus: ["!=", 2]}};
+				}}
+		],
+		primary_action_label: row ? __("Update") : __("Add"),
+		primary_action: function (values) {
+			dialog.hide();
+			const changed = {employee: values.employee, salary_slip: values.salary_slip || null};
+			update_salary_slip_rows(frm, row ? {updated: [$.extend({name: row.name}, changed)]} : {added: [changed]});
+		}
+	});
+	dialog.show();
+};
+
+// sends only the changed rows of a paged table; the voucher's timestamp is kept in step for the next save
+const update_salary_slip_rows = function (frm, changes) {
+	frappe.call({
+		method: 'oi_custom.customizations.payroll.paging.update_salary_slip_rows',
+		args: {payroll_voucher: frm.doc.name, changes: changes},
+		callback: function(r) {
+			frm.doc.modified = r.message.modified;
+			frm.salary_slip_totals = r.message.totals;
+			frm.events.render_salary_slip_pager(frm, frm.salary_slip_page_start);
+		}
+	});
+};
+
+
 // Submit salary slips
 
 // const submit_salary_slip = function (frm) {
@@ -256,4 +448,12 @@ frappe.ui.form.on('Payroll Voucher', {
 // 	} else {
 // 		frappe.msgprint(__("Company, From Date and To Date is mandatory"));
 // 	}
-// };
\ No newline at end of file
+// };
+
+const PAYROLL_JOB_PROGRESS_EVENT = 'payroll_job_progress';
+const PAYROLL_JOB_FINISHED_EVENT = 'payroll_job_finished';
+
+const show_payroll_job_progress = function(frm, job) {
+	let message = job.total ? __("{0} of {1}", [job.done, job.total]) : "";
+	frm.dashboard.show_progress(job.title, job.progress, message);
+};
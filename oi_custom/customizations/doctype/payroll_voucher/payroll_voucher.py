@@ -4,6 +4,7 @@
 
 from __future__ import unicode_literals
 import frappe
+from collections import OrderedDict
 from frappe.model.document import Document
 from dateutil.relativedelta import relativedelta
 from frappe.utils import cint, flt, nowdate, add_days, getdate, fmt_money, add_to_date, DATE_FORMAT
@@ -19,6 +20,25 @@ from erpnext.accounts.general_ledger import make_gl_entries
 from erpnext.hr.doctype.payroll_entry.payroll_entry import PayrollEntry
 import erpnext.hr.doctype.payroll_entry.payroll_entry
 
+from oi_custom.customizations.payroll.discovery import get_cached_employee_list
+from oi_custom.customizations.payroll.drafting import BulkSalarySlipDrafter
+from oi_custom.customizations.payroll.eligibility import get_eligible_employees
+from oi_custom.customizations.payroll.instrumentation import PayrollPhase
+from oi_custom.customizations.payroll.progress import PayrollProgress
+from oi_custom.customizations.payroll.lookups import PayrollLookups
+from oi_custom.customizations.payroll.paging import SALARY_SLIP_PAGING_THRESHOLD, get_salary_slip_totals, \
+	load_salary_slip_rows
+from oi_custom.customizations.payroll.general_ledger import make_bulk_gl_entries, merge_similar_gl_entries, \
+	to_minor_units, validate_gl_cancellation
+from oi_custom.customizations.payroll.booking import validate_salary_slips_not_booked, book_salary_slips, \
+	release_salary_slips
+from oi_custom.customizations.payroll.creation import validate_no_running_creation, enqueue_salary_slip_creation
+from oi_custom.customizations.payroll.cancellation import CANCELLATION_INLINE_LIMIT, enqueue_salary_slip_cancellation
+from oi_custom.customizations.payroll.submission import plan_salary_slip_submission, submit_salary_slip_chunk, \
+	submit_salary_slip_chunks, finish_salary_slip_submission
+from oi_custom.customizations.payroll.dispatch import plan_dispatch, get_structure_counts_for_employees, \
+	get_structure_counts_for_slips
+
 
 class PayrollVoucher(AccountsController, PayrollEntry):
 	"""
@@ -47,13 +67,10 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 			- sometimes, monthly employees are coming up with daily period is selected
 			- I need to go through this VERY CAREFULLY to make sure that the manual list is paramount, above and beyond anything else.
 			- Need to check what's happening with timesheets
-			- add reference to payroll voucher on submission of salary slips (can be done between save and submit)
 			- make deleting salary slips on cancel optional
 			- fix account currency stuff in new_gl_line
 			- highlighting and leaving project (others?) causes the table to get wiped
 			- adding or removing manually is not working right at present.
-			- need to check that a salary slip is not already booked by another payroll voucher (or at least make cancelling them optional, otherwise
-				may become uncancelable)
 			- currently creating a blank salary slip for people who don't fit the parameters when button is pressed (if they've been manually added)
 
 	"""
@@ -61,6 +78,46 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 	####################
 	### CRUD methods ###
 	####################
+	def onload(self):
+		"""
+			NEW: large salary slip tables are left out of the form, which pages through them instead
+		"""
+		self.page_salary_slips()
+
+	def validate(self):
+		"""
+			NEW: put back the rows of a paged table before anything works with them
+		"""
+		self.restore_paged_salary_slips()
+		super(PayrollVoucher, self).validate()
+
+	def before_cancel(self):
+		self.restore_paged_salary_slips()
+
+	def before_update_after_submit(self):
+		self.restore_paged_salary_slips()
+
+	def on_trash(self):
+		"""
+			NEW: delete the run logs, jobs and email records kept about this voucher, and clear it from batch runs,
+			since their links would otherwise stop a draft voucher from being deleted
+		"""
+		frappe.db.sql("""delete phase from `tabPayroll Voucher Run Phase` phase
+				inner join `tabPayroll Voucher Run Log` log on log.name = phase.parent
+			where phase.parenttype = 'Payroll Voucher Run Log' and log.payroll_voucher = %s""", self.name)
+		for doctype in ("Payroll Voucher Run Log", "Payroll Voucher Job", "Salary Slip Email"):
+			frappe.db.sql("""delete from `tab{0}` where payroll_voucher = %s""".format(doctype), self.name)
+		frappe.db.sql("""update `tabPayroll Batch Run Item` set payroll_voucher = null where payroll_voucher = %s""",
+			self.name)
+
+	def before_submit(self):
+		"""
+			MODIFIED: also refuses salary slips that another Payroll Voucher has already booked
+		"""
+		if hasattr(PayrollEntry, "before_submit"):
+			PayrollEntry.before_submit(self)
+		validate_salary_slips_not_booked(self.name, self.get_booked_salary_slips())
+
 	def on_submit(self):
 		"""
 			MODIFIED: submit unsubmitted salary slips on submission of payroll voucher
@@ -72,20 +129,59 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 			if ss.salary_slip is None:
 				frappe.get_doc("Payroll Salary Slip Detail", ss.name).cancel()
 				frappe.delete_doc("Payroll Salary Slip Detail", ss.name)
-		
-		# then, submit the remaining salary slips
+
+		# then, link the remaining salary slips to this voucher and submit them
+		book_salary_slips(self.name, self.get_booked_salary_slips())
 		self.submit_salary_slips()
 
 	def on_cancel(self):
 		"""
 			NEW: remove ledger entries on cancellation
+			large vouchers are handed to a background job that reverses the ledger and cancels the slips in chunks
+			either way, the slips are released at once so that another voucher can book them
+			the closed period and freezing date checks run here first, so the background job cannot be refused
 		"""
+		release_salary_slips(self.name)
+		if len(self.get_booked_salary_slips()) > CANCELLATION_INLINE_LIMIT:
+			validate_gl_cancellation(self.company, self.posting_date)
+			enqueue_salary_slip_cancellation(self.name)
+			frappe.msgprint(_("The Salary Slips of {0} are being cancelled in the background").format(self.name))
+			return
+
 		self.register_payroll_in_gl(cancel=True)
 		for slip in self.salary_slips:
 			if slip.salary_slip is not None:
 				frappe.get_doc("Salary Slip", slip.salary_slip).cancel()
 				slip.salary_slip = None
 
+	def resume_salary_slip_cancellation(self):
+		"""
+			NEW: start an interrupted background cancellation again; slips already cancelled are skipped
+		"""
+		if self.docstatus != 2:
+			frappe.throw(_("{0} has not been cancelled").format(self.name))
+
+		self.check_permission('cancel')
+		enqueue_salary_slip_cancellation(self.name)
+
+	def page_salary_slips(self):
+		"""
+			NEW: above SALARY_SLIP_PAGING_THRESHOLD rows, drop the salary slip table from this copy of the voucher
+			and flag it as paged; the server totals go along in __onload
+		"""
+		self.salary_slips_paged = 1 if len(self.salary_slips) > SALARY_SLIP_PAGING_THRESHOLD else 0
+		if self.salary_slips_paged:
+			self.set_onload("salary_slip_totals", get_salary_slip_totals(self.name))
+			self.set("salary_slips", [])
+
+	def restore_paged_salary_slips(self):
+		"""
+			NEW: a paged voucher comes back from the form without its rows; reload them, so that saving it does
+			not delete them and the methods below see the whole table
+		"""
+		if self.salary_slips_paged and not self.salary_slips and not self.is_new():
+			self.set("salary_slips", load_salary_slip_rows(self.name))
+
 
  	################################
 	### Doctype building methods ###
@@ -97,25 +193,39 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 			that fit the stipulated conditions (payroll freq, dates, branch, dept, designation, etc.). Then, it looks for salary
 			slips matching the period in question. If none are present, keeps the employee but leaves the salary slip spot blank.
 		"""
-		# first, clear out the existing salary slips table
-		self.set('salary_slips', [])
-
-		# then, get a list of employees matching the user-specified criteria, and create a line for them in the salary slips table
-		employees = self.get_emp_list()
-		if employees: 
-			for e in employees:
-				stub = frappe.new_doc("Payroll Salary Slip Detail")
-				stub.employee = e.employee
-				stub.employee_name = e.employee_name
-				self.append('salary_slips', stub)
-
-		# finally, check to see if a salary slip already exists for each employee for the period
-		if self.salary_slips:
-			for s in self.salary_slips:
-				match = frappe.get_list("Salary Slip", fields="*",
-					filters={"employee": s.employee, "start_date": self.start_date,
-								"end_date": self.end_date, "docstatus": ("!=", 2)})
-				if(len(match) == 1):
+		with PayrollPhase(self.name, "Populate"):
+			self.set('salary_slips', [])
+			for row in self.get_salary_slip_rows():
+				self.append('salary_slips', row)
+
+	def get_emp_list(self):
+		"""
+			MODIFIED: reads the Payroll Eligibility index with one parameterised range query, instead of joining
+			Employee, Salary Structure Assignment and Salary Structure on a condition built by string concatenation
+		"""
+		self.check_mandatory()
+		return get_eligible_employees(self)
+
+	def get_salary_slip_rows(self):
+		"""
+			NEW: the salary slip table rows for the current filters, as dicts. Employees come from the cached
+			employee discovery; their existing salary slips are always read fresh.
+		"""
+		# get a list of employees matching the user-specified criteria, and create a line for each of them
+		rows = [frappe._dict(employee=e.employee, employee_name=e.employee_name)
+			for e in get_cached_employee_list(self)]
+
+		# then check to see if a salary slip already exists for each employee for the period
+		if rows:
+			slips_by_employee = self.get_existing_salary_slips([s.employee for s in rows])
+			booked_elsewhere = []
+			for s in rows:
+				match = slips_by_employee.get(s.employee, [])
+				if len(match) == 1 and match[0].payroll_voucher and match[0].payroll_voucher != self.name:
+					booked_elsewhere.append(s)
+					frappe.msgprint(_("Salary Slip {0} of {1} is already booked by {2}")
+						.format(match[0].name, s.employee_name, match[0].payroll_voucher))
+				elif(len(match) == 1):
 					s.salary_slip = match[0].name
 					s.start_date = match[0].start_date
 					s.end_date = match[0].end_date
@@ -123,56 +233,112 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 				elif (len(match) > 1):
 					frappe.msgprint(_("Multiple salary slips in this period exist for {0}").format(s.employee_name))
 
+			# employees already paid through another voucher are left out
+			rows = [s for s in rows if s not in booked_elsewhere]
+
+		return rows
+
+	def get_existing_salary_slips(self, employees):
+		"""
+			NEW: fetch every non-cancelled salary slip for the period in a single query, indexed by employee, along
+			with the voucher that booked it
+		"""
+		slips_by_employee = {}
+		if not employees:
+			return slips_by_employee
+
+		slips = frappe.get_list("Salary Slip",
+			fields=["name", "employee", "start_date", "end_date", "docstatus", "payroll_voucher"],
+			filters={"employee": ("in", list(set(employees))), "start_date": self.start_date,
+						"end_date": self.end_date, "docstatus": ("!=", 2)},
+			limit_page_length=0)
+		for slip in slips:
+			slips_by_employee.setdefault(slip.employee, []).append(slip)
+
+		return slips_by_employee
+
 	def create_salary_slips(self):
 		"""
 			MODIFIED:
 				- to use self.salary_slips instead of self.get_emp_list(), 3rd line below
 				- to call customized create_salary_slips_for_employees_mod function instead of create_salary_slips_for_employees (different arguments)
 				- removes reference to payroll_entry
+				- runs expected to take longer than the inline latency budget are drafted by a background job
+				that fills in the table itself when it is done
 			Creates salary slip for selected employees if already not created
 		"""
 		self.check_permission('write')
+		validate_no_running_creation(self.name)
+		self.restore_paged_salary_slips()
 		self.created = 1
-		print("creating")
 		#emp_list = [d.employee for d in self.get_emp_list()]
 		emp_list = [d.employee for d in self.salary_slips]
 
 		if emp_list:
-			print(emp_list)
-			args = frappe._dict({
-				"salary_slip_based_on_timesheet": self.salary_slip_based_on_timesheet,
-				"payroll_frequency": self.payroll_frequency,
-				"start_date": self.start_date,
-				"end_date": self.end_date,
-				"company": self.company,
-				"posting_date": self.posting_date,
-				"deduct_tax_for_unclaimed_employee_benefits": self.deduct_tax_for_unclaimed_employee_benefits,
-				"deduct_tax_for_unsubmitted_tax_exemption_proof": self.deduct_tax_for_unsubmitted_tax_exemption_proof,
-				#"payroll_entry": self.name
-			})
-			if len(emp_list) > 30:
-				frappe.enqueue(create_salary_slips_for_employees_mod, timeout=600, employees=emp_list, slips=self.salary_slips, args=args)
+			args = self.get_salary_slip_args()
+			missing = [d.employee for d in self.salary_slips if not d.salary_slip]
+			dispatch = plan_dispatch("Create", self.payroll_frequency,
+				get_structure_counts_for_employees(self, missing), workers=False)
+			if not dispatch.inline:
+				# the job links the new slips to the saved rows, so the rows have to be saved first
+				self.save()
+				enqueue_salary_slip_creation(self.name, missing, args, queue=dispatch.queue, timeout=dispatch.timeout)
+				frappe.msgprint(_("Salary Slips are being created in the background"))
 			else:
-				print("creating slips")
-				create_salary_slips_for_employees_mod(emp_list, self.salary_slips, args, publish_progress=False)
-			
-			self.populate_salary_slip_table()
+				create_salary_slips_for_employees_mod(emp_list, self.salary_slips, args, publish_progress=False, payroll_voucher=self.name)
+				self.populate_salary_slip_table()
+				if self.salary_slips_paged:
+					self.save()
+
+			if self.salary_slips_paged:
+				# hand the form back a paged voucher rather than every row
+				self.page_salary_slips()
 
 
+	def get_salary_slip_args(self):
+		"""
+			NEW: the values every Salary Slip drafted for this voucher starts from
+		"""
+		return frappe._dict({
+			"salary_slip_based_on_timesheet": self.salary_slip_based_on_timesheet,
+			"payroll_frequency": self.payroll_frequency,
+			"start_date": self.start_date,
+			"end_date": self.end_date,
+			"company": self.company,
+			"posting_date": self.posting_date,
+			"deduct_tax_for_unclaimed_employee_benefits": self.deduct_tax_for_unclaimed_employee_benefits,
+			"deduct_tax_for_unsubmitted_tax_exemption_proof": self.deduct_tax_for_unsubmitted_tax_exemption_proof,
+			#"payroll_entry": self.name
+		})
+
 	def submit_salary_slips(self):
 		"""
 			MODIFIED: now uses salary slips listed in doc table rather than pulling from database
 			also uses modified submit_salary_slips_for_employees_mod function (necessary because frappe can't
 			override non-class functions)
+			batch runs (flags.submit_salary_slips_inline) already run in a worker and submit every chunk there
+			otherwise, slips expected to take longer than the inline latency budget are submitted in the background
 		"""
 		self.check_permission('write')
+		self.restore_paged_salary_slips()
 		#ss_list = self.get_sal_slip_list(ss_status=0)
 		ss_list = self.salary_slips
-		if len(ss_list) > 30:
-			frappe.enqueue(submit_salary_slips_for_employees_mod, timeout=600, payroll_entry=self, salary_slips=ss_list)
+		dispatch = plan_dispatch("Submit", self.payroll_frequency,
+			get_structure_counts_for_slips([d.salary_slip for d in ss_list if d.salary_slip]))
+		if not dispatch.inline and not self.flags.submit_salary_slips_inline:
+			submit_salary_slips_for_employees_mod(self, ss_list, enqueue=True, dispatch=dispatch)
 		else:
 			submit_salary_slips_for_employees_mod(self, ss_list, publish_progress=False)
 
+	def resume_salary_slip_submission(self):
+		"""
+			NEW: pick up a submission that was interrupted (worker timeout, failed chunk) from the last completed chunk
+		"""
+		if self.docstatus != 1 or self.salary_slips_submitted:
+			frappe.throw(_("There is no unfinished salary slip submission for {0}").format(self.name))
+
+		self.submit_salary_slips()
+
 
 	###############################
 	### LEDGER BUILDING METHODS ###
@@ -186,42 +352,38 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 			the payroll account.
 		"""
 		self.check_permission('write')
+		with PayrollPhase(self.name, "General Ledger"):
+			self.make_payroll_gl_entries(cancel=cancel, adv_adj=adv_adj)
+
+	def make_payroll_gl_entries(self, cancel=False, adv_adj=False):
+		"""
+			NEW: builds and posts the GL map for register_payroll_in_gl
+		"""
+		self._payroll_lookups = PayrollLookups(self.company)
 		default_payroll_payable_account = self.get_default_payroll_payable_account()
-		slips = self.salary_slips
+		payroll_account_is_type_payable = self.check_if_account_is_type_payable(default_payroll_payable_account)
 		gl_map = []
 
-		# manage earnings
-		earnings = self.get_salary_components(component_type="earnings") or {}
-		for earning in earnings:
-			earning["account"] = self.get_salary_component_account(earning["salary_component"])
-			is_flexible_benefit, only_tax_impact = frappe.db.get_value("Salary Component", earning['salary_component'], ['is_flexible_benefit', 'only_tax_impact'])
-			# if the earning is not actually salary but only_tax_impact, do not add it to the GL
-			if not (is_flexible_benefit and only_tax_impact):
+		# manage earnings and deductions, already summed per account (and per party for payable deductions)
+		for (parentfield, account, party, against_voucher), amount in self.get_salary_component_totals().items():
+			if parentfield == "earnings":
 				gl_map.append(self.new_gl_line(
-					account=self.get_salary_component_account(earning["salary_component"]),
-					debit=earning["amount"],
-					#against_voucher=earning["parent"],
-					#against_voucher_type="Salary Slip"
+					account=account,
+					debit=amount,
 				))
-
-		# manage deductions
-		deductions = self.get_salary_components(component_type="deductions") or {}
-		for deduction in deductions:
-			deduction["account"] = self.get_salary_component_account(deduction["salary_component"])
 			# if deduction account is not type payable, aggregate; otherwise, break into individual party components
-			if not self.check_if_account_is_type_payable(deduction["account"]):
+			elif not party:
 				gl_map.append(self.new_gl_line(
-					account=self.get_salary_component_account(deduction["salary_component"]),
-					credit=deduction["amount"],
+					account=account,
+					credit=amount,
 				))
 			else:
-				current_slip = frappe.get_doc("Salary Slip", deduction["parent"])
 				gl_map.append(self.new_gl_line(
-					account=self.get_salary_component_account(deduction["salary_component"]),
-					credit=deduction["amount"],
-					against_voucher=deduction["parent"],
+					account=account,
+					credit=amount,
+					against_voucher=against_voucher,
 					against_voucher_type="Salary Slip",
-					party=current_slip.employee,
+					party=party,
 					party_type="Employee"
 				))
 
@@ -247,29 +409,31 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 
 				))
 
-		# manage payable amounts
-		self.outstanding_amount = 0
-		for slip in slips:
-			if slip.salary_slip is not None:
-				ss = frappe.get_doc("Salary Slip", slip.salary_slip)
-				self.outstanding_amount += ss.net_pay
-				# if account type is not payable, aggregate the slips; otherwise, keep them separate
-				if not self.check_if_account_is_type_payable(default_payroll_payable_account):
-					gl_map.append(self.new_gl_line(
-						account=default_payroll_payable_account,
-						credit=ss.net_pay
-					))
-				else:
-					gl_map.append(self.new_gl_line(
-						account=default_payroll_payable_account,
-						credit=ss.net_pay,
-						against_voucher=ss.name,
-						against_voucher_type="Salary Slip",
-						party=ss.employee,
-						party_type="Employee"
-					))
-
-		print(self.outstanding_amount)
+		# manage payable amounts, added up in the currency's smallest unit so the total is exact
+		scale = self.get_payroll_lookups().get_minor_unit_scale()
+		outstanding_units = 0
+		net_pays = self.get_net_pays()
+		for ss in net_pays:
+			outstanding_units += to_minor_units(ss.net_pay, scale)
+		self.outstanding_amount = outstanding_units / float(scale)
+		# if account type is not payable, aggregate the slips; otherwise, keep them separate
+		if not payroll_account_is_type_payable:
+			if net_pays:
+				gl_map.append(self.new_gl_line(
+					account=default_payroll_payable_account,
+					credit=self.outstanding_amount
+				))
+		else:
+			for ss in net_pays:
+				gl_map.append(self.new_gl_line(
+					account=default_payroll_payable_account,
+					credit=ss.net_pay,
+					against_voucher=ss.name,
+					against_voucher_type="Salary Slip",
+					party=ss.employee,
+					party_type="Employee"
+				))
+
 		self.round_off_debit_credit(gl_map)
 		
 		## iterate through the gl_map to set "against" values for everything.
@@ -281,19 +445,27 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 			elif gle["debit"] > 0:
 				gle["against"] = credit_accts
 
-		make_gl_entries(gl_map, cancel=cancel, adv_adj=adv_adj, merge_entries=True)
+		if cancel:
+			make_gl_entries(merge_similar_gl_entries(gl_map), cancel=cancel, adv_adj=adv_adj, merge_entries=False)
+		else:
+			make_bulk_gl_entries(gl_map, adv_adj=adv_adj, merge_entries=True)
 
 
-	def new_gl_line(self, account=None, credit=None, debit=None, party=None, party_type=None, against_voucher=None, against_voucher_type=None):
+	def new_gl_line(self, account=None, credit=None, debit=None, party=None, party_type=None, against_voucher=None, against_voucher_type=None, against=None):
 		"""
 			NEW: Utility function to help register_payroll_in_gl
+			amounts are rounded once, to whole units of the company currency's smallest denomination; the line
+			carries them as integers (debit_units, credit_units) for round_off_debit_credit
 		"""
-		account_object = frappe.get_doc("Account", account)
-		return self.get_gl_dict({
+		lookups = self.get_payroll_lookups()
+		scale = lookups.get_minor_unit_scale()
+		debit_units, credit_units = to_minor_units(debit, scale), to_minor_units(credit, scale)
+		gl_line = self.get_gl_dict({
 			"account": account,
-			"account_currency": account_object.account_currency,
-			 "credit": flt(credit, frappe.get_precision("Journal Entry Account", "credit_in_account_currency")),
-			 "debit": flt(debit, frappe.get_precision("Journal Entry Account", "debit_in_account_currency")),
+			"against": against,
+			"account_currency": lookups.get_account(account).account_currency,
+			 "credit": credit_units / float(scale),
+			 "debit": debit_units / float(scale),
 			#"credit_in_account_currency": flt(credit, frappe.get_precision("Journal Entry Account", "credit_in_account_currency")),
 			#"debit_in_account_currency": flt(debit, frappe.get_precision("Journal Entry Account", "debit_in_account_currency")),
 			"party": party,
@@ -308,32 +480,81 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 			"company": self.company,
 			"posting_date": self.posting_date,
 		})
+		gl_line.debit_units, gl_line.credit_units = debit_units, credit_units
+		return gl_line
 
-	def get_salary_components(self, component_type):
+	def get_salary_component_totals(self):
+		"""
+			NEW: earnings and deductions of the voucher's slips summed by the database in a single query, grouped by
+			component and account, and for deductions booked to a payable account also by slip and employee.
+			Returns an ordered map of (parentfield, account, party, against_voucher) -> amount, earnings first.
 		"""
-			MODIFIED: select also parent field to be able to distinguish by individual salary slip
+		slips = self.get_booked_salary_slips()
+		totals = OrderedDict()
+		if not slips:
+			return totals
+
+		rows = frappe.db.sql("""
+			select
+				sd.parentfield, sd.salary_component, sca.default_account as account,
+				if(sd.parentfield = 'deductions' and acc.account_type = 'Payable', ss.employee, null) as party,
+				if(sd.parentfield = 'deductions' and acc.account_type = 'Payable', ss.name, null) as against_voucher,
+				sum(sd.amount) as amount
+			from
+				`tabSalary Detail` sd
+				inner join `tabSalary Slip` ss on ss.name = sd.parent
+				inner join `tabSalary Component` sc on sc.name = sd.salary_component
+				left join `tabSalary Component Account` sca
+					on sca.parent = sd.salary_component and sca.company = %(company)s
+				left join `tabAccount` acc on acc.name = sca.default_account
+			where
+				sd.parenttype = 'Salary Slip'
+				and sd.parentfield in ('earnings', 'deductions')
+				and sd.parent in %(salary_slips)s
+				and not (sd.parentfield = 'earnings' and sc.is_flexible_benefit = 1 and sc.only_tax_impact = 1)
+			group by
+				sd.parentfield, sd.salary_component, sca.default_account, party, against_voucher
+			order by
+				field(sd.parentfield, 'earnings', 'deductions'), account, party, against_voucher
+		""", {"company": self.company, "salary_slips": tuple(slips)}, as_dict=True)
+
+		for row in rows:
+			account = row.account or self.get_salary_component_account(row.salary_component)
+			key = (row.parentfield, account, row.party, row.against_voucher)
+			totals[key] = totals.get(key, 0) + flt(row.amount)
+
+		return totals
+
+	def get_net_pays(self):
 		"""
-		slips = [frappe.get_doc("Salary Slip", slip.salary_slip) for slip in self.salary_slips if slip.salary_slip is not None]
-		if slips:
-			salary_components = frappe.db.sql("""select salary_component, amount, parentfield, parent
-				from `tabSalary Detail` where parentfield = '%s' and parent in (%s)""" %
-				(component_type, ', '.join(['%s']*len(slips))), tuple([d.name for d in slips]), as_dict=True)
-			return salary_components
+			NEW: name, employee and net pay of every slip booked by the voucher, in one query
+		"""
+		slips = self.get_booked_salary_slips()
+		if not slips:
+			return []
+
+		return frappe.db.sql("""select name, employee, net_pay from `tabSalary Slip`
+			where name in %(salary_slips)s order by employee""", {"salary_slips": tuple(slips)}, as_dict=True)
+
+	def get_booked_salary_slips(self):
+		return [slip.salary_slip for slip in self.salary_slips if slip.salary_slip is not None]
 
 	def round_off_debit_credit(self, gl_map):
 		"""
 			NEW: add a rounding entry if necessary to balance credit/debit
+			MODIFIED: the difference is the exact sum of the lines' integer amounts (see new_gl_line), so no
+			line is rounded again and no floating point error builds up over a large map
 		"""
-		precision = get_field_precision(frappe.get_meta("GL Entry").get_field("debit"),
-			currency=frappe.db.get_value("Company", gl_map[0].company, "default_currency", cache=True))
+		scale = self.get_payroll_lookups().get_minor_unit_scale()
 
-		debit_credit_diff = 0.0
+		diff_units = 0
 		for entry in gl_map:
-			entry.debit = flt(entry.debit, precision)
-			entry.credit = flt(entry.credit, precision)
-			debit_credit_diff += entry.debit - entry.credit
+			debit_units, credit_units = entry.pop("debit_units", None), entry.pop("credit_units", None)
+			if debit_units is None:
+				debit_units, credit_units = to_minor_units(entry.debit, scale), to_minor_units(entry.credit, scale)
+			diff_units += debit_units - credit_units
 
-		debit_credit_diff = flt(debit_credit_diff, precision)
+		debit_credit_diff = diff_units / float(scale)
 		round_off_account, round_off_cost_center = get_round_off_account_and_cost_center(gl_map[0].company)
 		
 		round_off_gle = frappe._dict()
@@ -357,86 +578,74 @@ class PayrollVoucher(AccountsController, PayrollEntry):
 		gl_map.append(round_off_gle)
 
 	def check_if_account_is_type_payable(self, account):
-		acct_type = frappe.db.get_value(doctype="Account", fieldname="account_type", filters={"name": account})
-		is_payable = (acct_type == "Payable")
-		return is_payable
+		return self.get_payroll_lookups().is_payable(account)
+
+	def get_salary_component_account(self, salary_component):
+		"""
+			MODIFIED: served from the run's lookup cache instead of one query per call
+		"""
+		return self.get_payroll_lookups().get_salary_component_account(salary_component)
+
+	def get_payroll_lookups(self):
+		"""
+			NEW: the Account / Salary Component lookups for the current run, loaded on first use
+		"""
+		if not getattr(self, "_payroll_lookups", None):
+			self._payroll_lookups = PayrollLookups(self.company)
+		return self._payroll_lookups
 
 
 ##########################################
 ### non-class methods to be overridden ###
 ##########################################
 
-def submit_salary_slips_for_employees_mod(payroll_entry, salary_slips, publish_progress=True):
+def submit_salary_slips_for_employees_mod(payroll_entry, salary_slips, publish_progress=True, enqueue=False,
+	dispatch=None):
 	"""
 		MODIFIED AND RENAMED
+		submission is planned as a Payroll Voucher Job and split into chunks, which either run right here or
+		are shared out between the background jobs the dispatch plan asks for, on its queue (so several
+		workers can share them). Each chunk commits on its own, and the ledger is registered once after the
+		last chunk. Running this again after an interruption only submits the slips that are still drafts.
 	"""
-	submitted_ss = []
-	not_submitted_ss = []
-	frappe.flags.via_payroll_entry = True
-
-	count = 0
 	created_slips = [ss.salary_slip for ss in salary_slips if ss.salary_slip is not None]
+	job, chunks = plan_salary_slip_submission(payroll_entry.name, created_slips)
 
+	if not chunks:
+		finish_salary_slip_submission(job, commit=False)
 
+	if enqueue:
+		dispatch = dispatch or plan_dispatch("Submit", payroll_entry.payroll_frequency,
+			get_structure_counts_for_slips(created_slips))
+		workers = min(dispatch.workers, len(chunks))
+		for i in range(workers):
+			frappe.enqueue(submit_salary_slip_chunks, queue=dispatch.queue, timeout=dispatch.timeout,
+				enqueue_after_commit=True, job=job, chunks=chunks[i::workers], publish_progress=publish_progress)
+	else:
+		for chunk in chunks:
+			submit_salary_slip_chunk(job, chunk, commit=False, publish_progress=publish_progress)
 
-	for ss in created_slips:
-		ss_obj = frappe.get_doc("Salary Slip", ss)
-		if ss_obj.net_pay<0:
-			not_submitted_ss.append(ss[0])
-		else:
-			try:
-				ss_obj.submit()
-				submitted_ss.append(ss_obj)
-			except frappe.ValidationError:
-				not_submitted_ss.append(ss[0])
-		
-		count += 1
-		if publish_progress:
-			frappe.publish_progress(count*100/len(salary_slips), title = _("Submitting Salary Slips..."))
-
-	if submitted_ss:
-		#payroll_entry.make_accrual_jv_entry()
-		payroll_entry.register_payroll_in_gl(cancel=False)
-		frappe.msgprint(_("Salary Slip submitted for period from {0} to {1}")
-			.format(ss_obj.start_date, ss_obj.end_date))
-
-		payroll_entry.email_salary_slip(submitted_ss)
-	
-	payroll_entry.db_set("salary_slips_submitted", 1)
-	payroll_entry.notify_update()
 
-	if not submitted_ss and not not_submitted_ss:
-		frappe.msgprint(_("No salary slip found to submit for the above selected criteria"))
-
-	if not_submitted_ss:
-		frappe.msgprint(_("Could not submit some Salary Slips"))	
-
-
-def create_salary_slips_for_employees_mod(employees, slips, args, publish_progress=True):
+def create_salary_slips_for_employees_mod(employees, slips, args, publish_progress=True, commit=False, payroll_voucher=None,
+	job=None):
 	"""
 		MODIFIED AND RENAMED: simplified to operate off of the salary_slips table and not the database
-		
+		drafts the missing slips in bulk through BulkSalarySlipDrafter; pass commit=True from background jobs
+		to commit after every chunk of slips. The drafting is recorded on payroll_voucher's run log, if given,
+		and its progress against job.
 	"""
 	#salary_slips_exists_for = get_existing_salary_slips_mod(employees, args)
-	print("in the modzone")
-	salary_slips_exists_for = [ slip.employee for slip in slips if slip.salary_slip != None ]
-	count=0
-	print(employees)
-	print(salary_slips_exists_for)
+	salary_slips_exists_for = set(slip.employee for slip in slips if slip.salary_slip != None)
 
+	missing_slips_for = []
 	for emp in employees:
-		if emp not in salary_slips_exists_for:
-			args.update({
-				"doctype": "Salary Slip",
-				"employee": emp
-			})
-			ss = frappe.get_doc(args)
-			print(ss)
-			ss.insert()
-			count+=1
-			if publish_progress:
-				frappe.publish_progress(count*100/len(set(employees) - set(salary_slips_exists_for)),
-					title = _("Creating Salary Slips..."))
+		if emp not in salary_slips_exists_for and emp not in missing_slips_for:
+			missing_slips_for.append(emp)
+
+	progress = PayrollProgress(payroll_voucher, _("Creating Salary Slips..."), len(missing_slips_for), job=job) \
+		if publish_progress else None
+	with PayrollPhase(payroll_voucher, "Draft"):
+		BulkSalarySlipDrafter(args, missing_slips_for).run(progress=progress, commit=commit)
 
 	# payroll_entry = frappe.get_doc("Payroll Entry", args.payroll_entry)
 	# payroll_entry.db_set("salary_slips_created", 1)
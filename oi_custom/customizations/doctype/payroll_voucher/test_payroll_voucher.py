@@ -3,8 +3,213 @@
 # See license.txt
 from __future__ import unicode_literals
 
+import copy
+import datetime
 import frappe
 import unittest
 
+from erpnext.accounts.general_ledger import merge_similar_entries
+from frappe.utils import flt, rounded
+from oi_custom.customizations.payroll.general_ledger import merge_similar_gl_entries, to_minor_units, \
+	make_bulk_gl_entries
+from oi_custom.customizations.payroll.benchmark import make_synthetic_gl_map, make_unrounded_amounts, \
+	float_round_off_difference, minor_unit_round_off_difference, make_benchmark_company, make_benchmark_payroll_voucher
+from oi_custom.customizations.payroll.instrumentation import PayrollPhase
+from oi_custom.customizations.payroll.discovery import get_discovery_key
+from oi_custom.customizations.payroll.submission import plan_salary_slip_submission, submit_salary_slip_chunk, \
+	get_draft_salary_slips
+from oi_custom.customizations.payroll.booking import get_salary_slips_booked_elsewhere, \
+	validate_salary_slips_not_booked, book_salary_slips, release_salary_slips
+from oi_custom.customizations.payroll.paging import update_salary_slip_rows, load_salary_slip_rows
+from oi_custom.customizations.payroll.cancellation import cancel_salary_slips_for_voucher, CANCEL_JOB_TYPE
+from oi_custom.customizations.doctype.payroll_voucher.payroll_voucher import create_salary_slips_for_employees_mod
+
 class TestPayrollVoucher(unittest.TestCase):
-	pass
+	def test_keyed_gl_merge_matches_stock_merge(self):
+		gl_map = make_synthetic_gl_map(600, accounts=5, employees=40)
+		# a reversing line, so the amounts on its key can net out
+		gl_map.append(frappe._dict(gl_map[0], debit=-gl_map[0].debit, debit_in_account_currency=-gl_map[0].debit))
+
+		self.assertEqual(merge_similar_entries(copy.deepcopy(gl_map)), merge_similar_gl_entries(copy.deepcopy(gl_map)))
+
+	def test_minor_units_round_like_flt_and_add_up_exactly(self):
+		# exact halves, which the builtin round would send to the even neighbour on python 3
+		for amount in (0.125, 0.375, 2.5 / 100, -0.125, -0.375, 1.005):
+			self.assertEqual(to_minor_units(amount, 100) / 100.0, flt(amount, 2))
+		self.assertEqual((to_minor_units(0.125, 100), to_minor_units(-0.125, 100)), (13, -12))
+
+		amounts = make_unrounded_amounts(3000)
+		for debit, credit in amounts:
+			self.assertEqual(to_minor_units(debit, 100) / 100.0, flt(debit, 2))
+			self.assertEqual(to_minor_units(credit, 100) / 100.0, flt(credit, 2))
+
+		self.assertEqual(minor_unit_round_off_difference(amounts, 2), float_round_off_difference(amounts, 2))
+		# a thousand tenths add up to exactly 100 in cents, with nothing left to round off
+		self.assertEqual(minor_unit_round_off_difference([(0.1, 0)] * 1000 + [(0, 100)], 2), 0)
+
+	def test_minor_units_without_decimals_round_halves_to_even(self):
+		for amount in (0.5, 1.5, 2.5, 3.5, -0.5, -2.5, -3.5, 2.4, 2.6):
+			self.assertEqual(to_minor_units(amount, 1), rounded(amount, 0))
+		self.assertEqual([to_minor_units(amount, 1) for amount in (2.5, 3.5, -2.5)], [2, 4, -2])
+
+	def test_payroll_phase_counts_queries_and_rows(self):
+		with PayrollPhase(None, "Populate") as outer:
+			frappe.db.sql("select 1")
+			with PayrollPhase(None, "Draft") as inner:
+				frappe.db.sql("select 1 union select 2")
+
+		self.assertEqual((outer.queries, outer.rows_touched), (2, 3))
+		self.assertEqual((inner.queries, inner.rows_touched), (1, 2))
+		self.assertFalse("sql" in frappe.db.__dict__)
+
+	def test_discovery_key_normalises_filters(self):
+		typed = frappe._dict(company="_Test Company", payroll_frequency="Monthly", start_date=datetime.date(2019, 8, 1),
+			end_date=datetime.date(2019, 8, 31), salary_slip_based_on_timesheet=0, branch=None)
+		from_form = frappe._dict(company="_Test Company", payroll_frequency="Monthly", start_date="2019-08-01",
+			end_date="2019-08-31", salary_slip_based_on_timesheet="0", branch="", department=None)
+
+		self.assertEqual(get_discovery_key(typed), get_discovery_key(from_form))
+
+	def test_chunked_submission_reruns_only_what_is_left(self):
+		voucher = make_payroll_voucher_with_salary_slips(5)
+		salary_slips = voucher.get_booked_salary_slips()
+		# keep the last chunk from registering the voucher in the ledger
+		voucher.db_set("salary_slips_submitted", 1)
+
+		first_job, chunks = plan_salary_slip_submission(voucher.name, salary_slips, chunk_size=2)
+		self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+		submit_salary_slip_chunk(first_job, chunks[0], commit=False, publish_progress=False)
+
+		# the run stops after its first chunk; the next attempt plans only the slips still in draft
+		job, rerun_chunks = plan_salary_slip_submission(voucher.name, salary_slips, chunk_size=2)
+		self.assertEqual(sum(rerun_chunks, []), salary_slips[2:])
+		self.assertEqual(frappe.db.get_value("Payroll Voucher Job", first_job, "status"), "Superseded")
+
+		# a worker still holding a chunk of the superseded attempt leaves it to the new one
+		submit_salary_slip_chunk(first_job, chunks[1], commit=False, publish_progress=False)
+		self.assertEqual(get_draft_salary_slips(salary_slips), salary_slips[2:])
+
+		for chunk in rerun_chunks:
+			submit_salary_slip_chunk(job, chunk, commit=False, publish_progress=False)
+
+		self.assertEqual(get_draft_salary_slips(salary_slips), [])
+		self.assertEqual(frappe.db.get_value("Payroll Voucher Job", job,
+			["status", "completed_chunks", "processed_slips"]), ("Completed", 2, 3))
+
+	def test_component_totals_match_per_slip_sums(self):
+		voucher = make_payroll_voucher_with_salary_slips(4)
+
+		# what the ledger used to build by walking every row of every slip
+		expected = {}
+		for ss in voucher.get_booked_salary_slips():
+			slip = frappe.get_doc("Salary Slip", ss)
+			for parentfield in ("earnings", "deductions"):
+				for d in slip.get(parentfield):
+					account = voucher.get_salary_component_account(d.salary_component)
+					by_slip = parentfield == "deductions" and voucher.check_if_account_is_type_payable(account)
+					key = (parentfield, account, slip.employee if by_slip else None, slip.name if by_slip else None)
+					expected[key] = expected.get(key, 0) + flt(d.amount)
+
+		totals = voucher.get_salary_component_totals()
+		self.assertEqual(set(totals), set(expected))
+		for key, amount in expected.items():
+			self.assertAlmostEqual(totals[key], amount, places=6)
+		# earnings first, then deductions
+		parentfields = [key[0] for key in totals]
+		self.assertEqual(parentfields, sorted(parentfields, key=lambda parentfield: parentfield != "earnings"))
+
+	def test_bulk_gl_insert_posts_a_balanced_voucher(self):
+		voucher = make_payroll_voucher_with_salary_slips(4)
+		voucher.register_payroll_in_gl()
+
+		entries, debit, credit = frappe.db.sql("""select count(*), sum(debit), sum(credit) from `tabGL Entry`
+			where voucher_type = 'Payroll Voucher' and voucher_no = %s""", voucher.name)[0]
+		gross_pay = frappe.db.sql("""select sum(gross_pay) from `tabSalary Slip` where name in %(salary_slips)s""",
+			{"salary_slips": tuple(voucher.get_booked_salary_slips())})[0][0]
+		self.assertTrue(entries)
+		self.assertEqual(flt(debit, 2), flt(credit, 2))
+		self.assertEqual(flt(debit, 2), flt(gross_pay, 2))
+
+		# a map off by a cent is refused before anything is written
+		other = make_benchmark_payroll_voucher(voucher.company)
+		cash_account = frappe.db.get_value("Account", {"company": voucher.company, "account_type": "Cash", "is_group": 0})
+		expense_account = frappe.db.get_value("Company", voucher.company, "default_expense_account")
+		gl_map = [other.new_gl_line(account=expense_account, debit=100),
+			other.new_gl_line(account=cash_account, credit=99.99)]
+		self.assertRaises(frappe.ValidationError, make_bulk_gl_entries, gl_map)
+		self.assertFalse(frappe.db.exists("GL Entry", {"voucher_type": "Payroll Voucher", "voucher_no": other.name}))
+
+	def test_cancellation_can_run_again_after_an_interruption(self):
+		voucher = make_payroll_voucher_with_salary_slips(4)
+		salary_slips = voucher.get_booked_salary_slips()
+		job, chunks = plan_salary_slip_submission(voucher.name, salary_slips)
+		for chunk in chunks:
+			submit_salary_slip_chunk(job, chunk, commit=False, publish_progress=False)
+		self.assertTrue(frappe.db.exists("GL Entry", {"voucher_type": "Payroll Voucher", "voucher_no": voucher.name}))
+
+		# an earlier run got as far as cancelling the first slip
+		frappe.get_doc("Salary Slip", salary_slips[0]).cancel()
+
+		job = frappe.get_doc({"doctype": "Payroll Voucher Job", "payroll_voucher": voucher.name,
+			"job_type": CANCEL_JOB_TYPE, "status": "Queued"}).insert(ignore_permissions=True).name
+		cancel_salary_slips_for_voucher(job, publish_progress=False)
+		self.assertEqual(frappe.db.get_value("Payroll Voucher Job", job, ["status", "total_slips"]),
+			("Completed", len(salary_slips) - 1))
+
+		# and running it once more finds nothing left to do
+		cancel_salary_slips_for_voucher(job, publish_progress=False)
+		self.assertEqual(frappe.db.get_value("Payroll Voucher Job", job, ["status", "total_slips"]), ("Completed", 0))
+		self.assertEqual(set(frappe.db.sql_list("""select docstatus from `tabSalary Slip`
+			where name in %(salary_slips)s""", {"salary_slips": tuple(salary_slips)})), {2})
+		self.assertFalse(frappe.db.exists("GL Entry", {"voucher_type": "Payroll Voucher", "voucher_no": voucher.name}))
+
+	def test_paged_row_changes_apply_row_by_row(self):
+		voucher = make_payroll_voucher_with_salary_slips(3)
+		first, second, third = load_salary_slip_rows(voucher.name)
+
+		result = update_salary_slip_rows(voucher.name, {
+			"deleted": [second.name],
+			# idx is not editable and is left alone
+			"updated": [{"name": third.name, "salary_slip": None, "idx": 1}],
+			"added": [{"employee": second.employee, "salary_slip": second.salary_slip}]
+		})
+
+		rows = load_salary_slip_rows(voucher.name)
+		self.assertEqual([(d.idx, d.employee, d.salary_slip) for d in rows],
+			[(1, first.employee, first.salary_slip), (3, third.employee, None), (4, second.employee, second.salary_slip)])
+		self.assertEqual((rows[1].start_date, rows[1].end_date), (None, None))
+		self.assertEqual((rows[2].employee_name, rows[2].start_date, rows[2].end_date),
+			(second.employee_name, second.start_date, second.end_date))
+		self.assertEqual((result["totals"].total_rows, result["totals"].salary_slips), (3, 2))
+
+	def test_salary_slips_are_booked_by_one_voucher_at_a_time(self):
+		voucher = make_payroll_voucher_with_salary_slips(2)
+		salary_slips = voucher.get_booked_salary_slips()
+		other = make_benchmark_payroll_voucher(voucher.company)
+
+		book_salary_slips(other.name, salary_slips[:1])
+		self.assertEqual(get_salary_slips_booked_elsewhere(voucher.name, salary_slips), {salary_slips[0]: other.name})
+		self.assertEqual(get_salary_slips_booked_elsewhere(other.name, salary_slips), {})
+		self.assertRaises(frappe.ValidationError, validate_salary_slips_not_booked, voucher.name, salary_slips)
+
+		# once the other voucher lets go, the slips can be booked here
+		release_salary_slips(other.name)
+		validate_salary_slips_not_booked(voucher.name, salary_slips)
+		book_salary_slips(voucher.name, salary_slips)
+		self.assertEqual(get_salary_slips_booked_elsewhere(other.name, salary_slips),
+			dict((ss, voucher.name) for ss in salary_slips))
+
+
+def make_payroll_voucher_with_salary_slips(employees):
+	"""
+		a saved voucher of a fresh company, with a drafted salary slip on every row
+	"""
+	voucher = make_benchmark_payroll_voucher(make_benchmark_company(employees, structures=2, loan_ratio=0))
+	voucher.populate_salary_slip_table()
+	voucher.save()
+
+	create_salary_slips_for_employees_mod([d.employee for d in voucher.salary_slips], voucher.salary_slips,
+		voucher.get_salary_slip_args(), publish_progress=False, payroll_voucher=voucher.name)
+	voucher.populate_salary_slip_table()
+	voucher.save()
+	return voucher
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+
+class PayrollVoucherJob(Document):
+	"""
+		checkpoint and progress of a Payroll Voucher operation that runs in the background (salary slip creation,
+		submission or cancellation); see the oi_custom.customizations.payroll package
+	"""
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+
+class PayrollVoucherRunLog(Document):
+	"""
+		measurements of one run of a Payroll Voucher, phase by phase; see oi_custom.customizations.payroll.instrumentation
+	"""
+	pass
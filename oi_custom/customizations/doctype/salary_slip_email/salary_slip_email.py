@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+
+class SalarySlipEmail(Document):
+	"""
+		delivery of one submitted salary slip to its employee, kept apart from the payroll run that submitted
+		it; see oi_custom.customizations.payroll.emailing
+	"""
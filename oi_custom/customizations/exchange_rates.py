@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import cstr, getdate
+
+from erpnext.setup.utils import get_exchange_rate
+
+# redis hash of exchange rates shared by every worker on the site, one per "from|to|date"
+EXCHANGE_RATE_CACHE_KEY = "oi_custom:exchange_rates"
+
+# the hash is dropped this many seconds after the last rate was added, so rates erpnext fetched from outside
+# (which no Currency Exchange save announces) are looked up again
+EXCHANGE_RATE_CACHE_TTL = 600
+
+
+def get_cached_exchange_rate(from_currency, to_currency, transaction_date=None):
+	"""
+		erpnext's get_exchange_rate, memoised per (from currency, to currency, date) in redis, so every worker
+		shares the rates and saving a Currency Exchange clears them for all of them at once
+	"""
+	key = "|".join((cstr(from_currency), cstr(to_currency),
+		getdate(transaction_date).isoformat() if transaction_date else ""))
+	rate = frappe.cache().hget(EXCHANGE_RATE_CACHE_KEY, key)
+	if rate is None:
+		rate = get_exchange_rate(from_currency, to_currency, transaction_date)
+		frappe.cache().hset(EXCHANGE_RATE_CACHE_KEY, key, rate)
+		frappe.cache().expire(frappe.cache().make_key(EXCHANGE_RATE_CACHE_KEY), EXCHANGE_RATE_CACHE_TTL)
+
+	return rate
+
+
+def clear_exchange_rate_cache(doc=None, method=None):
+	"""
+		doc_events hook: forget every cached rate when a Currency Exchange record changes
+	"""
+	frappe.cache().delete_key(EXCHANGE_RATE_CACHE_KEY)
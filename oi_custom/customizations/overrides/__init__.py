@@ -1,12 +1,46 @@
-# from __future__ import unicode_literals
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
 
-# import frappe, erpnext
-# import frappe.defaults
-# from frappe.utils import nowdate, cstr, flt, cint, now, getdate
-# from frappe import throw, _, scrub
-# from frappe.utils import formatdate, get_number_format_info
+from __future__ import unicode_literals
+import frappe
 
-# from erpnext.accounts.doctype.payment_entry.payment_entry import PaymentEntry
-# from oi_custom.customizations.overrides.custom_payment_entry import custom_validate_reference_documents
-# from oi_custom.customizations.overrides.custom_payment_entry import custom_get_orders_to_be_billed
+# method overrides installed on stock code, as (module, attribute path in that module, replacement)
+OVERRIDES = (
+	("erpnext.accounts.doctype.payment_entry.payment_entry", "PaymentEntry.validate_reference_documents",
+		"oi_custom.customizations.overrides.custom_payment_entry.custom_validate_reference_documents"),
+	("erpnext.accounts.doctype.payment_entry.payment_entry", "get_orders_to_be_billed",
+		"oi_custom.customizations.overrides.custom_payment_entry.custom_get_orders_to_be_billed"),
+)
 
+# (module, attribute path) -> replacement, for every override installed in this process
+active_overrides = {}
+
+
+def apply_overrides():
+	"""
+		Install every override in OVERRIDES that is not installed yet. This runs once per process, when the app
+		is imported (see oi_custom/__init__.py), so every worker uses the overridden methods from its first
+		request on, without any hook running on save.
+	"""
+	for module_name, attribute, replacement in OVERRIDES:
+		if (module_name, attribute) in active_overrides:
+			continue
+
+		owner = frappe.get_module(module_name)
+		path = attribute.split(".")
+		for part in path[:-1]:
+			owner = getattr(owner, part)
+
+		setattr(owner, path[-1], frappe.get_attr(replacement))
+		active_overrides[(module_name, attribute)] = replacement
+
+
+@frappe.whitelist()
+def get_active_overrides():
+	"""
+		report the overrides installed in the process serving this request
+	"""
+	frappe.only_for("System Manager")
+	return [{"target": "{0}.{1}".format(module_name, attribute), "override": replacement}
+		for (module_name, attribute), replacement in sorted(active_overrides.items())]
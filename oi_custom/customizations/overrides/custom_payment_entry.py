@@ -1,63 +1,20 @@
 from __future__ import unicode_literals
 
+import json
+from six import string_types
+
 import frappe, erpnext
 import frappe.defaults
 from frappe.utils import nowdate, cstr, flt, cint, now, getdate
 from frappe import throw, _, scrub
-from frappe.utils import formatdate, get_number_format_info
+from frappe.utils import formatdate, get_number_format_info, comma_or
 
 from erpnext.accounts.doctype.payment_entry.payment_entry import PaymentEntry
-
-
-# def onloadping(doc,method):
-# 	print("############# hook method2")
-# 	print(doc.validate_reference_documents)
-# 	PaymentEntry.validate_reference_documents = custom_validate_reference_documents
-# 	print(doc.validate_reference_documents)
-
-# 	#PaymentEntry.get_orders_to_be_billed = custom_get_orders_to_be_billed
-# 	#print(PaymentEntry.validate_reference_documents)
-# 	#print(doc.validate_reference_documents)
-# 	#doc.validate_reference_documents(doc)
-
-	
-# 	#PaymentEntry.validate_reference_documents = custom_validate_reference_documents
-# 	#Pay.validate(doc)
-# 	#frappe.msgprint("zzzz")
-
-def customize_before_validate(doc,method):
-	print("&&&&&&&&&&&&&& before validate")
-	PaymentEntry.validate_reference_documents = custom_validate_reference_documents
-
-# def customize_payment_entry(doc,method):
-# 	print("############# hook method")
-# 	PaymentEntry.validate_reference_documents = custom_validate_reference_documents
-	
-# 	doc.setup_party_account_field()
-# 	doc.set_missing_values()
-# 	doc.validate_payment_type()
-# 	doc.validate_party_details()
-# 	doc.validate_bank_accounts()
-# 	doc.set_exchange_rate()
-# 	doc.validate_mandatory()
-# 	doc.validate_reference_documents()
-# 	doc.set_amounts()
-# 	doc.clear_unallocated_reference_document_rows()
-# 	doc.validate_payment_against_negative_invoice()
-# 	doc.validate_transaction_reference()
-# 	doc.set_title()
-# 	doc.set_remarks()
-# 	doc.validate_duplicate_entry()
-# 	doc.validate_allocated_amount()
-# 	doc.ensure_supplier_is_not_blocked()
-
-# 	return {'override': True}
+from oi_custom.customizations.exchange_rates import get_cached_exchange_rate
 
 
 # methods to override from payment_entry.py
 def custom_validate_reference_documents(self):
-	print("############# SUCCESSFUL OVERRIDE AAAAAAA")
-	#raise Exception('New method called intentionally!')
 	if self.party_type == "Student":
 		valid_reference_doctypes = ("Fees")
 	elif self.party_type == "Customer":
@@ -68,19 +25,19 @@ def custom_validate_reference_documents(self):
 		# erpnext_tinkererization: Payroll Voucher added to list of valid reference doctypes
 		valid_reference_doctypes = ("Expense Claim", "Journal Entry", "Employee Advance", "Payroll Voucher")
 
-	for d in self.get("references"):
-		if not d.allocated_amount:
-			continue
+	references = [d for d in self.get("references") if d.allocated_amount]
+	ref_docs = get_reference_documents(references, valid_reference_doctypes, self.party_type)
+
+	for d in references:
 		if d.reference_doctype not in valid_reference_doctypes:
 			frappe.throw(_("Reference Doctype must be one of {0}")
 				.format(comma_or(valid_reference_doctypes)))
 
 		elif d.reference_name:
-			if not frappe.db.exists(d.reference_doctype, d.reference_name):
+			ref_doc = ref_docs.get((d.reference_doctype, d.reference_name.lower()))
+			if not ref_doc:
 				frappe.throw(_("{0} {1} does not exist").format(d.reference_doctype, d.reference_name))
 			else:
-				ref_doc = frappe.get_doc(d.reference_doctype, d.reference_name)
-
 				if d.reference_doctype != "Journal Entry":
 					# erpnext_tinkererization: Payroll Voucher logic added (very simple as yet)
 					if d.reference_doctype != "Payroll Voucher" and self.party != ref_doc.get(scrub(self.party_type)):
@@ -89,15 +46,8 @@ def custom_validate_reference_documents(self):
 				else:
 					self.validate_journal_entry()
 
-				if d.reference_doctype in ("Sales Invoice", "Purchase Invoice", "Expense Claim", "Fees"):
-					if self.party_type == "Customer":
-						ref_party_account = ref_doc.debit_to
-					elif self.party_type == "Student":
-						ref_party_account = ref_doc.receivable_account
-					elif self.party_type=="Supplier":
-						ref_party_account = ref_doc.credit_to
-					elif self.party_type=="Employee":
-						ref_party_account = ref_doc.payable_account
+				if d.reference_doctype in PARTY_ACCOUNT_DOCTYPES:
+					ref_party_account = ref_doc.get(PARTY_ACCOUNT_FIELDS.get(self.party_type))
 
 					if ref_party_account != self.party_account:
 							frappe.throw(_("{0} {1} is associated with {2}, but Party Account is {3}")
@@ -108,8 +58,80 @@ def custom_validate_reference_documents(self):
 						.format(d.reference_doctype, d.reference_name))
 
 
+# reference doctypes whose party account must match the Payment Entry's, and the field holding it per party type
+PARTY_ACCOUNT_DOCTYPES = ("Sales Invoice", "Purchase Invoice", "Expense Claim", "Fees")
+PARTY_ACCOUNT_FIELDS = {
+	"Customer": "debit_to",
+	"Student": "receivable_account",
+	"Supplier": "credit_to",
+	"Employee": "payable_account"
+}
+
+
+def get_reference_documents(references, valid_reference_doctypes, party_type):
+	"""
+		fetch the referenced documents with one query per reference doctype, returning only the fields that
+		custom_validate_reference_documents checks, keyed by (doctype, lowercased name). References to doctypes that are
+		not valid for the party type are left out; the validation rejects those before looking them up.
+	"""
+	names_by_doctype = {}
+	for d in references:
+		if d.reference_name and d.reference_doctype in valid_reference_doctypes:
+			names_by_doctype.setdefault(d.reference_doctype, set()).add(d.reference_name)
+
+	ref_docs = {}
+	for doctype, names in names_by_doctype.items():
+		meta = frappe.get_meta(doctype)
+		fields = ["name", "docstatus"]
+		for fieldname in (scrub(party_type), PARTY_ACCOUNT_FIELDS.get(party_type)):
+			if fieldname and meta.has_field(fieldname):
+				fields.append(fieldname)
+
+		for ref_doc in frappe.get_all(doctype, filters={"name": ("in", list(names))}, fields=fields):
+			# names compare case-insensitively in the database, as they did for frappe.db.exists
+			ref_docs[(doctype, ref_doc.name.lower())] = ref_doc
+
+	return ref_docs
+
+
+# open orders returned per page, both to the stock outstanding documents lookup and to the pager
+ORDERS_PAGE_LENGTH = 100
+
+# hash of where each user's last stock lookup of a party's open orders stopped, keyed by get_orders_cursor_key;
+# an empty cursor means that lookup returned every open order
+ORDERS_CURSOR_CACHE_KEY = "payment_entry_orders_cursor"
+
+
 def custom_get_orders_to_be_billed(posting_date, party_type, party, party_account_currency, company_currency, cost_center=None):
-	print("###########SUCCESSFUL OVERRIDE BBBBBBB")
+	"""
+		MODIFIED: returns only the first ORDERS_PAGE_LENGTH open orders; the Payment Entry form loads the rest
+		page by page through get_orders_to_be_billed_page, starting from the cursor this lookup stores
+	"""
+	page = get_orders_to_be_billed_page(posting_date, party_type, party, party_account_currency, company_currency,
+		cost_center=cost_center)
+	frappe.cache().hset(ORDERS_CURSOR_CACHE_KEY, get_orders_cursor_key(party_type, party, party_account_currency,
+		company_currency, cost_center), page["cursor"] or [])
+	if page["cursor"]:
+		frappe.msgprint(_("Only the first {0} open orders were fetched. Use Load More Orders to add the rest.")
+			.format(ORDERS_PAGE_LENGTH))
+
+	return page["orders"]
+
+
+def get_orders_cursor_key(party_type, party, party_account_currency, company_currency, cost_center=None):
+	return "|".join(cstr(value) for value in (frappe.session.user, party_type, party, party_account_currency,
+		company_currency, cost_center))
+
+
+@frappe.whitelist()
+def get_orders_to_be_billed_page(posting_date, party_type, party, party_account_currency, company_currency,
+	cost_center=None, cursor=None, page_length=ORDERS_PAGE_LENGTH, resume=0):
+	"""
+		One page of the party's open orders, in (transaction_date, name) order, starting after cursor: the
+		[transaction_date, name] of the last order of the previous page. Returns the orders and the cursor for
+		the next page, which is None once there are no more orders. With resume and no cursor, the page follows
+		the one the stock outstanding documents lookup last returned for this party.
+	"""
 	if party_type == "Customer":
 		voucher_type = 'Sales Order'
 	elif party_type == "Supplier":
@@ -117,47 +139,75 @@ def custom_get_orders_to_be_billed(posting_date, party_type, party, party_accoun
 	elif party_type == "Employee":
 		voucher_type = None
 
+	if not voucher_type:
+		return {"orders": [], "cursor": None}
+
+	frappe.has_permission(voucher_type, throw=True)
+	page_length = min(cint(page_length) or ORDERS_PAGE_LENGTH, ORDERS_PAGE_LENGTH)
+	if isinstance(cursor, string_types):
+		cursor = json.loads(cursor)
+
+	if not cursor and cint(resume):
+		cursor = frappe.cache().hget(ORDERS_CURSOR_CACHE_KEY, get_orders_cursor_key(party_type, party,
+			party_account_currency, company_currency, cost_center))
+		if cursor == []:
+			return {"orders": [], "cursor": None}
+
 	# Add cost center condition
-	# erpnext_tinkererization: added a check here to see if voucher_type exists, otherwise get_doc is liable to crash
-	if voucher_type:
-		doc = frappe.get_doc({"doctype": voucher_type})
-		condition = ""
-		if doc and hasattr(doc, 'cost_center'):
-			condition = " and cost_center='%s'" % cost_center
-
-	orders = []
-	if voucher_type:
-		ref_field = "base_grand_total" if party_account_currency == company_currency else "grand_total"
-
-		orders = frappe.db.sql("""
-			select
-				name as voucher_no,
-				{ref_field} as invoice_amount,
-				({ref_field} - advance_paid) as outstanding_amount,
-				transaction_date as posting_date
-			from
-				`tab{voucher_type}`
-			where
-				{party_type} = %s
-				and docstatus = 1
-				and ifnull(status, "") != "Closed"
-				and {ref_field} > advance_paid
-				and abs(100 - per_billed) > 0.01
-				{condition}
-			order by
-				transaction_date, name
-		""".format(**{
-			"ref_field": ref_field,
-			"voucher_type": voucher_type,
-			"party_type": scrub(party_type),
-			"condition": condition
-		}), party, as_dict=True)
-
-	order_list = []
+	# erpnext_tinkererization: added a check here to see if voucher_type exists; the field check reads the cached
+	# doctype meta rather than building a new document
+	condition = ""
+	if cost_center and frappe.get_meta(voucher_type).has_field("cost_center"):
+		condition = " and cost_center = %(cost_center)s"
+
+	if cursor:
+		condition += """ and (transaction_date > %(after_date)s
+			or (transaction_date = %(after_date)s and name > %(after_name)s))"""
+
+	ref_field = "base_grand_total" if party_account_currency == company_currency else "grand_total"
+
+	# one row more than the page, to know whether another page follows
+	orders = frappe.db.sql("""
+		select
+			name as voucher_no,
+			{ref_field} as invoice_amount,
+			({ref_field} - advance_paid) as outstanding_amount,
+			transaction_date as posting_date
+		from
+			`tab{voucher_type}`
+		where
+			{party_type} = %(party)s
+			and docstatus = 1
+			and ifnull(status, "") != "Closed"
+			and {ref_field} > advance_paid
+			and abs(100 - per_billed) > 0.01
+			{condition}
+		order by
+			transaction_date, name
+		limit %(limit)s
+	""".format(**{
+		"ref_field": ref_field,
+		"voucher_type": voucher_type,
+		"party_type": scrub(party_type),
+		"condition": condition
+	}), {
+		"party": party,
+		"cost_center": cost_center,
+		"after_date": cursor[0] if cursor else None,
+		"after_name": cursor[1] if cursor else None,
+		"limit": page_length + 1
+	}, as_dict=True)
+
+	next_cursor = None
+	if len(orders) > page_length:
+		orders = orders[:page_length]
+		next_cursor = [orders[-1].posting_date, orders[-1].voucher_no]
+
+	if orders:
+		# This assumes that the exchange rate required is the one in the SO
+		exchange_rate = get_cached_exchange_rate(party_account_currency, company_currency, posting_date)
 	for d in orders:
 		d["voucher_type"] = voucher_type
-		# This assumes that the exchange rate required is the one in the SO
-		d["exchange_rate"] = get_exchange_rate(party_account_currency, company_currency, posting_date)
-		order_list.append(d)
+		d["exchange_rate"] = exchange_rate
 
-	return order_list
\ No newline at end of file
+	return {"orders": orders, "cursor": next_cursor}
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+
+# helpers shared by the Payroll Voucher doctype for processing large payroll runs
+
+
+def chunk_list(items, chunk_size):
+	"""
+		split a list into consecutive lists of at most chunk_size items
+	"""
+	return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
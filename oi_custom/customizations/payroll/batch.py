@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import json
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt, now, time_diff_in_seconds
+
+# redis counter of the vouchers writing to the database right now, shared by every batch run on the site
+WRITE_SLOTS_KEY = "payroll_batch_write_slots"
+
+# a worker that dies holding a slot leaks it; the counter expires this long after the last slot was taken
+WRITE_SLOTS_EXPIRY = 3600
+
+# seconds between two attempts at taking a slot
+WRITE_SLOT_POLL_INTERVAL = 2
+
+# the timeout of one row's job; a row still running this long (plus a margin) after it started has lost its worker
+BATCH_ITEM_TIMEOUT = 7200
+BATCH_ITEM_STALE_AFTER = BATCH_ITEM_TIMEOUT + 300
+
+
+class PayrollWriteSlot(object):
+	"""
+		A counting semaphore in redis that caps how many batch vouchers write to the database at once:
+
+			with PayrollWriteSlot(batch_run.max_concurrent_writes):
+				...
+
+		Waits until fewer than max_writes slots are taken. The cap is read by whoever takes a slot, so runs
+		with different caps share the one counter.
+	"""
+	def __init__(self, max_writes):
+		self.max_writes = max(cint(max_writes), 1)
+		self.key = frappe.cache().make_key(WRITE_SLOTS_KEY)
+
+	def __enter__(self):
+		cache = frappe.cache()
+		while True:
+			if cache.incr(self.key) <= self.max_writes:
+				cache.expire(self.key, WRITE_SLOTS_EXPIRY)
+				return self
+			cache.decr(self.key)
+			time.sleep(WRITE_SLOT_POLL_INTERVAL)
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		# never below zero, should the counter have expired while the slot was held
+		if frappe.cache().decr(self.key) < 0:
+			frappe.cache().set(self.key, 0)
+
+
+def enqueue_batch_run(batch_run):
+	"""
+		one background job per queued row, so the vouchers are processed by as many workers as are free
+	"""
+	for item in batch_run.items:
+		if item.status == "Queued":
+			frappe.enqueue(run_batch_item, queue="long", timeout=BATCH_ITEM_TIMEOUT, enqueue_after_commit=True,
+				batch_run=batch_run.name, item=item.name)
+
+
+def run_batch_item(batch_run, item):
+	"""
+		Create the row's Payroll Voucher, populate it, draft its salary slips and, if the batch asks for it,
+		submit it. The voucher is committed after each step, so a failure leaves the work done so far in place
+		and the row can be run again; a row that already has a voucher carries on with it.
+	"""
+	settings = frappe.db.get_value("Payroll Batch Run", batch_run,
+		["posting_date", "max_concurrent_writes", "submit_vouchers"], as_dict=True)
+	spec = frappe.get_doc("Payroll Batch Run Item", item)
+	frappe.db.sql("""update `tabPayroll Batch Run` set status = 'Running' where name = %s and status = 'Queued'""",
+		batch_run)
+	frappe.db.set_value("Payroll Batch Run Item", item, {"status": "Running", "started": now()})
+	frappe.db.commit()
+
+	start = time.time()
+	try:
+		with PayrollWriteSlot(settings.max_concurrent_writes):
+			voucher = get_batch_voucher(spec, settings.posting_date)
+			frappe.db.set_value("Payroll Batch Run Item", item, "payroll_voucher", voucher.name)
+			frappe.db.commit()
+
+			draft_batch_voucher(voucher)
+			if cint(settings.submit_vouchers) and voucher.docstatus == 0:
+				voucher.flags.submit_salary_slips_inline = True
+				voucher.submit()
+				frappe.db.commit()
+
+		frappe.db.set_value("Payroll Batch Run Item", item, {
+			"status": "Completed",
+			"seconds": flt(time.time() - start, 3),
+			"salary_slips": len([d for d in voucher.salary_slips if d.salary_slip])
+		})
+		frappe.db.commit()
+
+	except Exception:
+		frappe.db.rollback()
+		frappe.db.set_value("Payroll Batch Run Item", item, {
+			"status": "Failed",
+			"seconds": flt(time.time() - start, 3),
+			"error": frappe.get_traceback()
+		})
+		frappe.db.commit()
+
+	finish_batch_run(batch_run)
+
+
+def is_batch_item_stale(item):
+	"""
+		whether a running row's job has outlived its timeout, i.e. it was killed or its worker crashed
+	"""
+	return item.status == "Running" and (not item.started
+		or time_diff_in_seconds(now(), item.started) > BATCH_ITEM_STALE_AFTER)
+
+
+def reset_stale_batch_items(batch_run):
+	"""
+		mark the rows whose job died while running them as failed, so that the batch can be run again
+	"""
+	for item in batch_run.items:
+		if is_batch_item_stale(item):
+			item.update({"status": "Failed", "error": _("The job running this row stopped without reporting back")})
+
+
+def get_batch_voucher(spec, posting_date):
+	if spec.payroll_voucher and frappe.db.exists("Payroll Voucher", spec.payroll_voucher):
+		return frappe.get_doc("Payroll Voucher", spec.payroll_voucher)
+
+	voucher = frappe.get_doc({
+		"doctype": "Payroll Voucher",
+		"company": spec.company,
+		"branch": spec.branch,
+		"payroll_frequency": spec.payroll_frequency,
+		"start_date": spec.start_date,
+		"end_date": spec.end_date,
+		"posting_date": posting_date,
+		"cost_center": spec.cost_center or frappe.db.get_value("Company", spec.company, "cost_center")
+	})
+	voucher.insert()
+	return voucher
+
+
+def draft_batch_voucher(voucher):
+	"""
+		fill the voucher's table, draft the slips it lacks and fill it again with them, as the form would
+	"""
+	from oi_custom.customizations.doctype.payroll_voucher.payroll_voucher import \
+		create_salary_slips_for_employees_mod
+
+	if voucher.docstatus != 0:
+		return
+
+	voucher.populate_salary_slip_table()
+	voucher.save()
+	frappe.db.commit()
+
+	create_salary_slips_for_employees_mod([d.employee for d in voucher.salary_slips], voucher.salary_slips,
+		voucher.get_salary_slip_args(), publish_progress=False, commit=True, payroll_voucher=voucher.name)
+
+	voucher.populate_salary_slip_table()
+	voucher.save()
+	frappe.db.commit()
+
+
+def finish_batch_run(batch_run):
+	"""
+		once no row is queued or running, write the run's summary; the batch row is locked so that only the
+		last job to finish writes it
+	"""
+	batch = frappe.db.sql("""select name, status, started from `tabPayroll Batch Run`
+		where name = %s for update""", batch_run, as_dict=True)[0]
+	items = frappe.get_all("Payroll Batch Run Item", filters={"parent": batch_run, "parenttype": "Payroll Batch Run"},
+		fields=["idx", "company", "branch", "payroll_frequency", "start_date", "end_date", "payroll_voucher",
+			"status", "seconds", "salary_slips", "error"], order_by="idx")
+
+	if batch.status not in ("Queued", "Running") or any(d.status in ("Queued", "Running") for d in items):
+		frappe.db.commit()
+		return
+
+	finished = now()
+	summary = get_batch_run_summary(items, time_diff_in_seconds(finished, batch.started) if batch.started else 0)
+	frappe.db.set_value("Payroll Batch Run", batch_run, {
+		"status": "Failed" if summary["failed_vouchers"] else "Completed",
+		"finished": finished,
+		"completed_vouchers": summary["completed_vouchers"],
+		"failed_vouchers": summary["failed_vouchers"],
+		"total_seconds": summary["total_seconds"],
+		"summary": json.dumps(summary, indent=1, sort_keys=True, default=str)
+	})
+	frappe.db.commit()
+	frappe.get_doc("Payroll Batch Run", batch_run).notify_update()
+
+
+def get_batch_run_summary(items, total_seconds):
+	"""
+		timings and failures of a finished batch run. voucher_seconds adds up the time each voucher took, so
+		comparing it with total_seconds shows how much the workers overlapped.
+	"""
+	completed = [d for d in items if d.status == "Completed"]
+	failed = [d for d in items if d.status == "Failed"]
+
+	return {
+		"vouchers": len(items),
+		"completed_vouchers": len(completed),
+		"failed_vouchers": len(failed),
+		"salary_slips": sum(cint(d.salary_slips) for d in completed),
+		"total_seconds": flt(total_seconds, 3),
+		"voucher_seconds": flt(sum(flt(d.seconds) for d in items), 3),
+		"slowest": max(items, key=lambda d: flt(d.seconds)).payroll_voucher if items else None,
+		"rows": [{
+			"row": d.idx,
+			"company": d.company,
+			"branch": d.branch,
+			"payroll_frequency": d.payroll_frequency,
+			"period": "{0} - {1}".format(d.start_date, d.end_date),
+			"payroll_voucher": d.payroll_voucher,
+			"status": d.status,
+			"seconds": flt(d.seconds, 3),
+			"salary_slips": cint(d.salary_slips),
+			# the last line of the traceback names the error
+			"error": (d.error or "").strip().split("\n")[-1] or None
+		} for d in items]
+	}
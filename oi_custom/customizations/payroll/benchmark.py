@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+"""
+	Benchmarks for payroll processing. Run them against a site with e.g.
+
+		bench --site mysite execute oi_custom.customizations.payroll.benchmark.benchmark_gl_merge
+		bench --site mysite execute oi_custom.customizations.payroll.benchmark.benchmark_gl_round_off
+		bench --site mysite execute oi_custom.customizations.payroll.benchmark.benchmark_payroll_voucher \
+			--kwargs "{'employee_counts': [100, 1000], 'output': '/tmp/payroll_voucher.json'}"
+
+	Each benchmark returns its results and, when given an output path, also writes them there as JSON.
+	benchmark_payroll_voucher creates companies, employees and submitted documents and leaves them in place for
+	inspection, so it only runs on sites with allow_tests set (i.e. local development and test sites), and only
+	when run as above, never from the test suite.
+"""
+
+from __future__ import unicode_literals
+import copy
+import json
+import random
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import flt, nowdate, now, get_first_day, get_last_day, add_years, add_days
+
+from erpnext.accounts.general_ledger import merge_similar_entries
+from oi_custom.customizations.payroll.general_ledger import merge_similar_gl_entries, to_minor_units
+
+GL_MERGE_SIZES = (1000, 10000, 50000)
+
+PAYROLL_VOUCHER_EMPLOYEE_COUNTS = (100, 1000, 10000)
+
+# earnings and deductions of the synthetic salary structures, as (component, abbr, type, formula)
+BENCHMARK_COMPONENTS = (
+	("Benchmark Basic", "BMB", "Earning", "base * .6"),
+	("Benchmark Allowance", "BMA", "Earning", "base * .4"),
+	("Benchmark Income Tax", "BMT", "Deduction", "(BMB + BMA) * .1"),
+)
+
+
+def make_synthetic_gl_map(lines, accounts=25, employees=None, seed=1):
+	"""
+		a GL map shaped like a per-employee payroll voucher: a few expense and deduction accounts without a party,
+		and a payable account split by employee and salary slip
+	"""
+	rng = random.Random(seed)
+	employees = employees or max(lines // 5, 1)
+	gl_map = []
+	for i in range(lines):
+		if i % 3:
+			employee = "EMP-{0:05d}".format(rng.randrange(employees))
+			entry = {"account": "Payroll Payable - BM", "party_type": "Employee", "party": employee,
+				"against_voucher_type": "Salary Slip", "against_voucher": "Sal Slip/" + employee,
+				"credit": rng.randint(1, 100000) / 100.0, "debit": 0}
+		else:
+			entry = {"account": "Salary Account {0} - BM".format(rng.randrange(accounts)),
+				"party_type": None, "party": None, "against_voucher_type": None, "against_voucher": None,
+				"debit": rng.randint(1, 100000) / 100.0, "credit": 0}
+
+		entry.update({"cost_center": "Main - BM", "project": None,
+			"debit_in_account_currency": entry["debit"], "credit_in_account_currency": entry["credit"]})
+		gl_map.append(frappe._dict(entry))
+
+	return gl_map
+
+
+def benchmark_gl_merge(sizes=GL_MERGE_SIZES, output=None):
+	"""
+		time the stock quadratic merge against the Payroll Voucher's keyed merge and check they agree
+	"""
+	results = []
+	for size in sizes:
+		gl_map = make_synthetic_gl_map(size)
+
+		stock_input, keyed_input = copy.deepcopy(gl_map), copy.deepcopy(gl_map)
+		stock_time, stock_merged = timed(merge_similar_entries, stock_input)
+		keyed_time, keyed_merged = timed(merge_similar_gl_entries, keyed_input)
+
+		results.append({
+			"benchmark": "gl_merge",
+			"lines": len(gl_map),
+			"merged_lines": len(keyed_merged),
+			"stock_seconds": stock_time,
+			"keyed_seconds": keyed_time,
+			"speedup": flt(stock_time / keyed_time, 2) if keyed_time else None,
+			"identical": stock_merged == keyed_merged
+		})
+
+	write_results(results, output)
+	return results
+
+
+def make_unrounded_amounts(lines, seed=1):
+	"""
+		(debit, credit) pairs with more decimals than the currency has, as salary component formulas produce them
+	"""
+	rng = random.Random(seed)
+	return [(rng.randint(1, 10 ** 8) / 1000.0, 0) if i % 3 == 0 else (0, rng.randint(1, 10 ** 8) / 1000.0)
+		for i in range(lines)]
+
+
+def float_round_off_difference(amounts, precision):
+	"""
+		the former float path: each line rounded with flt when it is built and again when the round-off entry is
+		worked out, and the difference added up as a float
+	"""
+	lines = [(flt(debit, precision), flt(credit, precision)) for debit, credit in amounts]
+
+	debit_credit_diff = 0.0
+	for debit, credit in lines:
+		debit, credit = flt(debit, precision), flt(credit, precision)
+		debit_credit_diff += debit - credit
+	return flt(debit_credit_diff, precision)
+
+
+def minor_unit_round_off_difference(amounts, precision):
+	"""
+		the integer path: each line rounded once into the currency's smallest unit, and the difference added up
+		exactly
+	"""
+	scale = 10 ** precision
+	lines = [(to_minor_units(debit, scale), to_minor_units(credit, scale)) for debit, credit in amounts]
+
+	diff_units = 0
+	for debit_units, credit_units in lines:
+		diff_units += debit_units - credit_units
+	return diff_units / float(scale)
+
+
+def benchmark_gl_round_off(sizes=GL_MERGE_SIZES, precision=2, output=None):
+	"""
+		time the float and integer ways of rounding a GL map's lines and working out its round-off entry, and
+		check they arrive at the same difference
+	"""
+	results = []
+	for size in sizes:
+		amounts = make_unrounded_amounts(size)
+		float_time, float_diff = timed(float_round_off_difference, amounts, precision)
+		integer_time, integer_diff = timed(minor_unit_round_off_difference, amounts, precision)
+
+		results.append({
+			"benchmark": "gl_round_off",
+			"lines": size,
+			"float_seconds": float_time,
+			"integer_seconds": integer_time,
+			"speedup": flt(float_time / integer_time, 2) if integer_time else None,
+			"float_difference": float_diff,
+			"integer_difference": integer_diff,
+			"identical": float_diff == integer_diff
+		})
+
+	write_results(results, output)
+	return results
+
+
+def benchmark_payroll_voucher(employee_counts=PAYROLL_VOUCHER_EMPLOYEE_COUNTS, structures=3, loan_ratio=0.1,
+	output=None):
+	"""
+		Time the four phases of a Payroll Voucher run separately, once per employee count, each against a fresh
+		synthetic company: populate_salary_slip_table, create_salary_slips, submit_salary_slips and
+		register_payroll_in_gl. Setup is timed too but reported on its own.
+
+		The phases are driven synchronously (no background jobs), and slip submission is run with the ledger
+		registration held back so that register_payroll_in_gl can be timed by itself afterwards.
+	"""
+	if not frappe.conf.allow_tests:
+		frappe.throw(_("The payroll benchmark creates test data; set allow_tests in the site config to run it"))
+
+	from oi_custom.customizations.doctype.payroll_voucher.payroll_voucher import \
+		create_salary_slips_for_employees_mod, submit_salary_slips_for_employees_mod
+
+	results = []
+	for count in employee_counts:
+		setup_time, company = timed(make_benchmark_company, count, structures=structures, loan_ratio=loan_ratio)
+		frappe.db.commit()
+
+		voucher = make_benchmark_payroll_voucher(company)
+		phases = {}
+
+		phases["populate_salary_slip_table"] = timed(voucher.populate_salary_slip_table)[0]
+		voucher.save()
+		frappe.db.commit()
+
+		employees = [d.employee for d in voucher.salary_slips]
+		phases["create_salary_slips"] = timed(create_salary_slips_for_employees_mod,
+			employees, voucher.salary_slips, voucher.get_salary_slip_args(), publish_progress=False, commit=True,
+			payroll_voucher=voucher.name)[0]
+		voucher.populate_salary_slip_table()
+		voucher.save()
+		frappe.db.commit()
+
+		# keep the last chunk from registering the voucher, so the ledger gets its own timing below
+		voucher.db_set("salary_slips_submitted", 1)
+		phases["submit_salary_slips"] = timed(submit_salary_slips_for_employees_mod,
+			voucher, voucher.salary_slips, publish_progress=False)[0]
+		frappe.db.commit()
+		voucher.db_set("salary_slips_submitted", 0)
+
+		voucher.reload()
+		phases["register_payroll_in_gl"] = timed(voucher.register_payroll_in_gl)[0]
+		frappe.db.commit()
+
+		results.append({
+			"benchmark": "payroll_voucher",
+			"timestamp": now(),
+			"company": company,
+			"payroll_voucher": voucher.name,
+			"employees": count,
+			"salary_structures": structures,
+			"loans": frappe.db.count("Loan", {"company": company, "docstatus": 1}),
+			"salary_slips": frappe.db.count("Salary Slip", {"company": company, "docstatus": 1}),
+			"gl_entries": frappe.db.count("GL Entry", {"voucher_type": "Payroll Voucher", "voucher_no": voucher.name}),
+			"run_logs": frappe.get_all("Payroll Voucher Run Log", filters={"payroll_voucher": voucher.name}),
+			"setup_seconds": setup_time,
+			"phase_seconds": phases,
+			"total_seconds": sum(phases.values())
+		})
+
+	write_results(results, output)
+	return results
+
+
+def make_benchmark_company(employees, structures=3, loan_ratio=0.1):
+	"""
+		a fresh company with its holiday list, salary components and structures, and the given number of
+		active employees spread over the structures; loan_ratio of the employees also repay a loan from salary
+	"""
+	abbr = "PB" + frappe.generate_hash(length=3).upper()
+	company = frappe.get_doc({
+		"doctype": "Company",
+		"company_name": "Payroll Benchmark {0} {1}".format(employees, abbr),
+		"abbr": abbr,
+		"default_currency": frappe.db.get_default("currency") or "USD",
+		"country": frappe.db.get_default("country") or "United States",
+		"create_chart_of_accounts_based_on": "Standard Template",
+		"chart_of_accounts": "Standard"
+	}).insert()
+
+	start_date = get_first_day(nowdate())
+	company.db_set("default_holiday_list", make_benchmark_holiday_list(company.name, start_date))
+	company.db_set("default_payroll_payable_account", get_benchmark_account(company.name, "Payroll Payable")
+		or company.default_payable_account)
+
+	make_benchmark_components(company.name)
+	salary_structures = [make_benchmark_salary_structure(company.name, i) for i in range(structures)]
+
+	loan_every = int(1 / loan_ratio) if loan_ratio else 0
+	for i in range(employees):
+		employee = make_benchmark_employee(company.name, i)
+		assign_benchmark_salary_structure(employee, salary_structures[i % len(salary_structures)],
+			company.name, start_date, base=20000 + (i % 50) * 1000)
+		if loan_every and i % loan_every == 0:
+			make_benchmark_loan(employee, company.name, start_date)
+
+		if i % 500 == 499:
+			frappe.db.commit()
+
+	return company.name
+
+
+def make_benchmark_holiday_list(company, start_date):
+	return frappe.get_doc({
+		"doctype": "Holiday List",
+		"holiday_list_name": "{0} Holidays".format(company),
+		"from_date": add_years(start_date, -1),
+		"to_date": add_years(start_date, 1)
+	}).insert().name
+
+
+def get_benchmark_account(company, account_name):
+	return frappe.db.get_value("Account", {"company": company, "account_name": account_name, "is_group": 0})
+
+
+def make_benchmark_account(company, account_name, root_type, account_type=None):
+	parent = frappe.db.sql("""select name from `tabAccount`
+		where company = %s and root_type = %s and is_group = 1 order by lft limit 1""", (company, root_type))[0][0]
+	return frappe.get_doc({
+		"doctype": "Account",
+		"account_name": account_name,
+		"parent_account": parent,
+		"company": company,
+		"account_type": account_type
+	}).insert().name
+
+
+def make_benchmark_components(company):
+	"""
+		create the benchmark salary components if needed and point them at accounts of this company
+	"""
+	earnings_account = get_benchmark_account(company, "Salary") \
+		or frappe.db.get_value("Company", company, "default_expense_account")
+	deductions_account = frappe.db.get_value("Company", company, "default_payroll_payable_account")
+
+	for component, abbr, component_type, formula in BENCHMARK_COMPONENTS:
+		if frappe.db.exists("Salary Component", component):
+			doc = frappe.get_doc("Salary Component", component)
+		else:
+			doc = frappe.get_doc({
+				"doctype": "Salary Component",
+				"salary_component": component,
+				"salary_component_abbr": abbr,
+				"type": component_type
+			})
+		doc.append("accounts", {
+			"company": company,
+			"default_account": earnings_account if component_type == "Earning" else deductions_account
+		})
+		doc.save()
+
+
+def make_benchmark_salary_structure(company, index):
+	structure = frappe.get_doc({
+		"doctype": "Salary Structure",
+		"name": "{0} Structure {1}".format(company, index),
+		"company": company,
+		"payroll_frequency": "Monthly",
+		"is_active": "Yes",
+		"earnings": [],
+		"deductions": []
+	})
+	for component, abbr, component_type, formula in BENCHMARK_COMPONENTS:
+		structure.append("earnings" if component_type == "Earning" else "deductions", {
+			"salary_component": component,
+			"abbr": abbr,
+			"amount_based_on_formula": 1,
+			"formula": formula
+		})
+	structure.insert()
+	structure.submit()
+	return structure.name
+
+
+def make_benchmark_employee(company, index):
+	return frappe.get_doc({
+		"doctype": "Employee",
+		"first_name": "Benchmark",
+		"last_name": "{0:05d}".format(index),
+		"gender": "Female" if index % 2 else "Male",
+		"date_of_birth": "1985-01-01",
+		"date_of_joining": "2015-01-01",
+		"company": company,
+		"status": "Active"
+	}).insert().name
+
+
+def assign_benchmark_salary_structure(employee, salary_structure, company, from_date, base):
+	assignment = frappe.get_doc({
+		"doctype": "Salary Structure Assignment",
+		"employee": employee,
+		"salary_structure": salary_structure,
+		"company": company,
+		"from_date": from_date,
+		"base": base
+	})
+	assignment.insert()
+	assignment.submit()
+
+
+def make_benchmark_loan(employee, company, start_date):
+	"""
+		a submitted loan repaid from salary, with its first instalment due within the benchmark period
+	"""
+	loan_type = "Payroll Benchmark Loan"
+	if not frappe.db.exists("Loan Type", loan_type):
+		frappe.get_doc({
+			"doctype": "Loan Type",
+			"loan_name": loan_type,
+			"maximum_loan_amount": 1000000,
+			"rate_of_interest": 12
+		}).insert()
+
+	loan_account = get_benchmark_account(company, "Benchmark Employee Loans") \
+		or make_benchmark_account(company, "Benchmark Employee Loans", "Asset")
+	interest_account = get_benchmark_account(company, "Benchmark Loan Interest") \
+		or make_benchmark_account(company, "Benchmark Loan Interest", "Income")
+
+	loan = frappe.get_doc({
+		"doctype": "Loan",
+		"applicant_type": "Employee",
+		"applicant": employee,
+		"loan_type": loan_type,
+		"company": company,
+		"posting_date": add_days(start_date, -1),
+		"loan_amount": 120000,
+		"repayment_method": "Repay Over Number of Periods",
+		"repayment_periods": 12,
+		"repayment_start_date": add_days(start_date, 14),
+		"repay_from_salary": 1,
+		"mode_of_payment": "Cash",
+		"payment_account": frappe.db.get_value("Account", {"company": company, "account_type": "Cash", "is_group": 0}),
+		"loan_account": loan_account,
+		"interest_income_account": interest_account
+	})
+	loan.insert()
+	loan.submit()
+	loan.db_set("status", "Disbursed")
+	loan.db_set("disbursement_date", add_days(start_date, -1))
+
+
+def make_benchmark_payroll_voucher(company):
+	start_date = get_first_day(nowdate())
+	voucher = frappe.get_doc({
+		"doctype": "Payroll Voucher",
+		"company": company,
+		"posting_date": get_last_day(start_date),
+		"payroll_frequency": "Monthly",
+		"start_date": start_date,
+		"end_date": get_last_day(start_date),
+		"cost_center": frappe.db.get_value("Company", company, "cost_center")
+	})
+	voucher.insert()
+	return voucher
+
+
+def timed(fn, *args, **kwargs):
+	start = time.time()
+	result = fn(*args, **kwargs)
+	return time.time() - start, result
+
+
+def write_results(results, output=None):
+	if output:
+		with open(output, "w") as f:
+			json.dump(results, f, indent=1, sort_keys=True, default=str)
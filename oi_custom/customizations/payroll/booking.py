@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe import _
+
+from oi_custom.customizations.payroll import chunk_list
+
+# salary slip names looked up or updated per statement
+BOOKING_BATCH_SIZE = 1000
+
+
+def get_salary_slips_booked_elsewhere(payroll_voucher, salary_slips, for_update=False):
+	"""
+		{salary slip: booking voucher} for the slips that another voucher has already booked. With for_update,
+		the slips stay locked until the transaction ends, so two vouchers cannot book them at the same time.
+	"""
+	booked = {}
+	for batch in chunk_list(sorted(set(ss for ss in salary_slips if ss)), BOOKING_BATCH_SIZE):
+		for name, docstatus, booked_by in frappe.db.sql("""select name, docstatus, payroll_voucher
+			from `tabSalary Slip` where name in %(salary_slips)s {for_update}""".format(
+				for_update="for update" if for_update else ""), {"salary_slips": tuple(batch)}):
+			if docstatus != 2 and booked_by and booked_by != payroll_voucher:
+				booked[name] = booked_by
+	return booked
+
+
+def validate_salary_slips_not_booked(payroll_voucher, salary_slips):
+	booked = get_salary_slips_booked_elsewhere(payroll_voucher, salary_slips, for_update=True)
+	if booked:
+		frappe.throw(_("These Salary Slips are already booked by another Payroll Voucher: {0}").format(
+			", ".join("{0} ({1})".format(ss, booked[ss]) for ss in sorted(booked))))
+
+
+def book_salary_slips(payroll_voucher, salary_slips):
+	"""
+		point the slips at the voucher that books them
+	"""
+	for batch in chunk_list(list(set(ss for ss in salary_slips if ss)), BOOKING_BATCH_SIZE):
+		frappe.db.sql("""update `tabSalary Slip` set payroll_voucher = %(payroll_voucher)s
+			where name in %(salary_slips)s""", {"salary_slips": tuple(batch), "payroll_voucher": payroll_voucher})
+
+
+def release_salary_slips(payroll_voucher):
+	"""
+		clear the link on every slip the voucher booked, so they can be booked again
+	"""
+	frappe.db.sql("""update `tabSalary Slip` set payroll_voucher = null where payroll_voucher = %s""",
+		payroll_voucher)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe import _
+from frappe.utils import now
+
+from oi_custom.customizations.payroll import chunk_list
+from oi_custom.customizations.payroll.general_ledger import cancel_bulk_gl_entries
+from oi_custom.customizations.payroll.progress import PayrollProgress, get_job_progress_columns, clear_job_progress, \
+	publish_job_finished
+from oi_custom.customizations.payroll.submission import get_unfinished_job, mark_job_failed
+
+# vouchers booking more slips than this are cancelled by a background job
+CANCELLATION_INLINE_LIMIT = 30
+
+# number of salary slips cancelled between two commits
+CANCELLATION_CHUNK_SIZE = 100
+
+CANCEL_JOB_TYPE = "Cancel Salary Slips"
+
+
+def enqueue_salary_slip_cancellation(payroll_voucher):
+	"""
+		record a cancellation job for the voucher and hand it to a worker once the cancel itself is committed
+	"""
+	job_name = get_unfinished_job(payroll_voucher, CANCEL_JOB_TYPE)
+	job = frappe.get_doc("Payroll Voucher Job", job_name) if job_name else frappe.new_doc("Payroll Voucher Job")
+	job.update({
+		"payroll_voucher": payroll_voucher,
+		"job_type": CANCEL_JOB_TYPE,
+		"status": "Queued",
+		"chunk_size": CANCELLATION_CHUNK_SIZE,
+		"progress": 0,
+		"progress_updated": now(),
+		"error": None
+	})
+	job.flags.ignore_permissions = True
+	job.save()
+
+	frappe.enqueue(cancel_salary_slips_for_voucher, queue="long", timeout=3600, enqueue_after_commit=True,
+		job=job.name)
+	return job.name
+
+
+def cancel_salary_slips_for_voucher(job, publish_progress=True):
+	"""
+		Background cancellation of a Payroll Voucher: reverse its GL entries in one go, then cancel its slips
+		chunk by chunk with a commit after each chunk. Only slips that are still submitted are picked up, so
+		a run that was interrupted can simply be started again.
+	"""
+	payroll_voucher = frappe.db.get_value("Payroll Voucher Job", job, "payroll_voucher")
+	try:
+		frappe.db.set_value("Payroll Voucher Job", job, "status", "Running")
+		cancel_bulk_gl_entries("Payroll Voucher", payroll_voucher)
+		frappe.db.commit()
+
+		salary_slips = get_submitted_salary_slips(payroll_voucher)
+		chunks = chunk_list(salary_slips, CANCELLATION_CHUNK_SIZE)
+		frappe.db.sql("""update `tabPayroll Voucher Job`
+			set total_slips = %s, processed_slips = 0, total_chunks = %s, completed_chunks = 0, progress = 0
+			where name = %s""", (len(salary_slips), len(chunks), job))
+		frappe.db.commit()
+
+		progress = PayrollProgress(payroll_voucher, _("Cancelling Salary Slips..."), len(salary_slips), job=job) \
+			if publish_progress else None
+		cancelled = 0
+		for chunk in chunks:
+			for ss in chunk:
+				frappe.get_doc("Salary Slip", ss).cancel()
+				cancelled += 1
+				if progress:
+					progress.update(cancelled)
+
+			frappe.db.sql("""update `tabPayroll Voucher Job`
+				set {progress}, completed_chunks = completed_chunks + 1, processed_slips = processed_slips + %s
+				where name = %s""".format(progress=get_job_progress_columns(len(chunk))), (len(chunk), job))
+			frappe.db.commit()
+
+		frappe.db.set_value("Payroll Voucher Job", job, "status", "Completed")
+		clear_job_progress(job)
+		frappe.db.commit()
+		publish_job_finished(payroll_voucher, job)
+
+	except Exception:
+		frappe.db.rollback()
+		mark_job_failed(job)
+		publish_job_finished(payroll_voucher, job)
+		raise
+
+
+def get_submitted_salary_slips(payroll_voucher):
+	"""
+		the voucher's slips that are still submitted, in table order
+	"""
+	return frappe.db.sql_list("""select detail.salary_slip
+		from `tabPayroll Salary Slip Detail` detail
+			inner join `tabSalary Slip` ss on ss.name = detail.salary_slip
+		where detail.parent = %s and detail.parenttype = 'Payroll Voucher' and ss.docstatus = 1
+		order by detail.idx""", payroll_voucher)
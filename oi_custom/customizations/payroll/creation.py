@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe import _
+from frappe.utils import now
+
+from oi_custom.customizations.payroll.progress import get_running_job, clear_job_progress, publish_job_finished
+from oi_custom.customizations.payroll.submission import get_unfinished_job, mark_job_failed
+
+CREATE_JOB_TYPE = "Create Salary Slips"
+
+
+def validate_no_running_creation(payroll_voucher):
+	"""
+		refuse to draft slips for a voucher while a background job is still drafting them. The voucher row
+		stays locked until the request commits, so two requests cannot both find no job and both enqueue one.
+	"""
+	frappe.db.sql("""select name from `tabPayroll Voucher` where name = %s for update""", payroll_voucher)
+	job = get_running_job(payroll_voucher, CREATE_JOB_TYPE)
+	if job:
+		frappe.throw(_("Salary Slips for {0} are already being created ({1}). The table will be filled in when "
+			"they are done.").format(payroll_voucher, job))
+
+
+def enqueue_salary_slip_creation(payroll_voucher, employees, args, queue="long", timeout=3600):
+	"""
+		record a creation job for the voucher and hand it to a worker once the voucher is committed
+	"""
+	job_name = get_unfinished_job(payroll_voucher, CREATE_JOB_TYPE)
+	job = frappe.get_doc("Payroll Voucher Job", job_name) if job_name else frappe.new_doc("Payroll Voucher Job")
+	job.update({
+		"payroll_voucher": payroll_voucher,
+		"job_type": CREATE_JOB_TYPE,
+		"status": "Queued",
+		"total_slips": len(employees),
+		"processed_slips": 0,
+		"progress": 0,
+		"progress_updated": now(),
+		"error": None
+	})
+	job.flags.ignore_permissions = True
+	job.save()
+
+	frappe.enqueue(create_salary_slips_for_voucher, queue=queue, timeout=timeout, enqueue_after_commit=True,
+		job=job.name, employees=employees, args=args)
+	return job.name
+
+
+def create_salary_slips_for_voucher(job, employees, args):
+	"""
+		Background drafting for a Payroll Voucher. Employees who already have a slip for the period (e.g. from
+		an earlier attempt) are skipped. The voucher's table is filled in by link_created_salary_slips when the
+		job ends, failed or not, since every chunk drafted before a failure is already committed; the form is
+		then told to reload once that is committed too.
+	"""
+	from oi_custom.customizations.doctype.payroll_voucher.payroll_voucher import \
+		create_salary_slips_for_employees_mod
+
+	payroll_voucher = frappe.db.get_value("Payroll Voucher Job", job, "payroll_voucher")
+	try:
+		frappe.db.set_value("Payroll Voucher Job", job, "status", "Running")
+		frappe.db.commit()
+
+		employees = get_employees_without_salary_slip(employees, args)
+		create_salary_slips_for_employees_mod(employees, [], args, commit=True, payroll_voucher=payroll_voucher,
+			job=job)
+
+		link_created_salary_slips(payroll_voucher)
+		frappe.db.sql("""update `tabPayroll Voucher Job`
+			set status = 'Completed', processed_slips = total_slips, progress = 100, progress_updated = %s
+			where name = %s""", (now(), job))
+		frappe.db.commit()
+
+	except Exception:
+		frappe.db.rollback()
+		mark_job_failed(job)
+		link_salary_slips_after_failure(payroll_voucher)
+		raise
+
+	finally:
+		clear_job_progress(job)
+		frappe.get_doc("Payroll Voucher", payroll_voucher).notify_update()
+		publish_job_finished(payroll_voucher, job)
+
+
+def link_salary_slips_after_failure(payroll_voucher):
+	"""
+		link what a failed job committed, without hiding the job's own error if linking fails as well
+	"""
+	try:
+		link_created_salary_slips(payroll_voucher)
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(frappe.get_traceback(), _("Could not link the Salary Slips of {0}").format(payroll_voucher))
+
+
+def get_employees_without_salary_slip(employees, args):
+	"""
+		the employees, in order, who have no non-cancelled salary slip for the period yet
+	"""
+	if not employees:
+		return []
+
+	existing = set(frappe.db.sql_list("""select distinct employee from `tabSalary Slip`
+		where docstatus != 2 and start_date = %(start_date)s and end_date = %(end_date)s
+			and employee in %(employees)s""",
+		{"start_date": args.start_date, "end_date": args.end_date, "employees": tuple(employees)}))
+	return [e for e in employees if e not in existing]
+
+
+def link_created_salary_slips(payroll_voucher):
+	"""
+		Fill in the salary slip (and the columns populate_salary_slip_table copies from it) of every row that
+		has none, in one UPDATE joining the voucher's rows to the slips of its period. As when the table is
+		populated, only an employee's single non-cancelled slip is taken, and not if another voucher has booked it.
+	"""
+	start_date, end_date = frappe.db.get_value("Payroll Voucher", payroll_voucher, ["start_date", "end_date"])
+	frappe.db.sql("""update `tabPayroll Salary Slip Detail` detail
+			inner join (
+				select employee, min(name) as name, min(start_date) as start_date, min(end_date) as end_date,
+					min(ifnull(payroll_voucher, '')) as booked_by
+				from `tabSalary Slip`
+				where docstatus != 2 and start_date = %(start_date)s and end_date = %(end_date)s
+				group by employee
+				having count(*) = 1
+			) ss on ss.employee = detail.employee
+		set detail.salary_slip = ss.name, detail.start_date = ss.start_date, detail.end_date = ss.end_date
+		where detail.parent = %(payroll_voucher)s and detail.parenttype = 'Payroll Voucher'
+			and ifnull(detail.salary_slip, '') = '' and ss.booked_by in ('', %(payroll_voucher)s)""",
+		{"payroll_voucher": payroll_voucher, "start_date": start_date, "end_date": end_date})
+
+	frappe.db.sql("""update `tabPayroll Voucher` set modified = %s where name = %s""", (now(), payroll_voucher))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import json
+from six import string_types
+
+import frappe
+from frappe.utils import cint, cstr, getdate
+
+from oi_custom.customizations.payroll.instrumentation import PayrollPhase
+
+# redis hash of employee lists, one per normalised set of Payroll Voucher filters
+EMPLOYEE_DISCOVERY_CACHE_KEY = "oi_custom:payroll_employee_discovery"
+
+# the Payroll Voucher fields that decide which employees are found
+DISCOVERY_FILTERS = ("company", "payroll_frequency", "start_date", "end_date", "salary_slip_based_on_timesheet",
+	"branch", "department", "designation")
+
+
+@frappe.whitelist()
+def find_relevant_employees(filters, payroll_voucher=None):
+	"""
+		the salary slip table rows of a Payroll Voucher with these filters, without sending the whole voucher
+		to the server; used by the form while the filters are being edited. For a saved voucher, pass its name
+		so that the lookup is recorded as a Populate phase on its run log.
+	"""
+	if isinstance(filters, string_types):
+		filters = json.loads(filters)
+
+	frappe.has_permission("Payroll Voucher", "write", throw=True)
+
+	with PayrollPhase(payroll_voucher, "Populate"):
+		doc = frappe.new_doc("Payroll Voucher")
+		doc.update(dict((f, filters.get(f)) for f in DISCOVERY_FILTERS))
+		doc.name = payroll_voucher
+		return doc.get_salary_slip_rows()
+
+
+def get_cached_employee_list(payroll_voucher):
+	"""
+		payroll_voucher.get_emp_list(), cached by the normalised filter tuple until an Employee, Salary
+		Structure or Salary Structure Assignment changes
+	"""
+	key = get_discovery_key(payroll_voucher)
+	employees = frappe.cache().hget(EMPLOYEE_DISCOVERY_CACHE_KEY, key)
+	if employees is None:
+		employees = [{"employee": e.employee, "employee_name": e.employee_name}
+			for e in payroll_voucher.get_emp_list() or []]
+		frappe.cache().hset(EMPLOYEE_DISCOVERY_CACHE_KEY, key, employees)
+
+	return [frappe._dict(e) for e in employees]
+
+
+def get_discovery_key(payroll_voucher):
+	"""
+		the filters as one string, with dates in ISO form and unset filters as empty strings
+	"""
+	values = []
+	for f in DISCOVERY_FILTERS:
+		value = payroll_voucher.get(f)
+		if f in ("start_date", "end_date"):
+			value = getdate(value).isoformat() if value else ""
+		elif f == "salary_slip_based_on_timesheet":
+			value = cint(value)
+		values.append(cstr(value))
+
+	return "|".join(values)
+
+
+def clear_employee_discovery(doc=None, method=None):
+	"""
+		doc_events hook: drop every cached employee list when employees or their salary structures change
+	"""
+	frappe.cache().delete_key(EMPLOYEE_DISCOVERY_CACHE_KEY)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import math
+
+import frappe
+from frappe.utils import cint, flt, now
+
+# used for any Payroll Dispatch Settings that have not been saved
+DISPATCH_DEFAULTS = {
+	"inline_latency_budget": 20,
+	"default_seconds_per_slip": 0.5,
+	"timing_weight": 0.2,
+	"long_queue_after": 300,
+	"max_workers": 4,
+	"seconds_per_worker": 600
+}
+
+# the shortest timeout a background payroll job gets, and how far its estimate is stretched for it
+MIN_JOB_TIMEOUT = 1500
+JOB_TIMEOUT_FACTOR = 3
+
+
+def get_dispatch_settings():
+	settings = frappe._dict(DISPATCH_DEFAULTS)
+	for field, value in frappe.db.get_singles_dict("Payroll Dispatch Settings").items():
+		if field in settings and flt(value) > 0:
+			settings[field] = flt(value)
+	return settings
+
+
+def plan_dispatch(operation, payroll_frequency, structure_counts, workers=True):
+	"""
+		Decide how to run an operation ("Create" or "Submit") over salary slips, given {salary structure:
+		number of slips}. The cost is estimated from the recorded seconds per slip of each structure and
+		frequency. Returns a dict with:
+			inline: whether the estimate fits the inline latency budget
+			estimate: the expected seconds
+			queue: "long" beyond long_queue_after, "default" otherwise
+			workers: jobs to split the work over, one per seconds_per_worker of work up to max_workers
+				(always 1 when workers is False, for operations that cannot be split)
+			timeout: for each of those jobs
+	"""
+	settings = get_dispatch_settings()
+	timings = get_slip_timings(operation, payroll_frequency, list(structure_counts))
+	estimate = sum(count * timings.get(structure, settings.default_seconds_per_slip)
+		for structure, count in structure_counts.items())
+
+	job_count = 1
+	if workers:
+		job_count = min(cint(settings.max_workers), max(1, int(math.ceil(estimate / settings.seconds_per_worker))))
+
+	return frappe._dict({
+		"inline": estimate <= settings.inline_latency_budget,
+		"estimate": flt(estimate, 1),
+		"queue": "long" if estimate > settings.long_queue_after else "default",
+		"workers": job_count,
+		"timeout": max(MIN_JOB_TIMEOUT, int(estimate / job_count * JOB_TIMEOUT_FACTOR))
+	})
+
+
+def get_slip_timings(operation, payroll_frequency, salary_structures):
+	"""
+		{salary structure: recorded seconds per slip}
+	"""
+	if not salary_structures:
+		return {}
+
+	return dict(frappe.db.sql("""select salary_structure, seconds_per_slip from `tabPayroll Slip Timing`
+		where operation = %(operation)s and ifnull(payroll_frequency, '') = %(payroll_frequency)s
+			and salary_structure in %(salary_structures)s""", {
+			"operation": operation,
+			"payroll_frequency": payroll_frequency or "",
+			"salary_structures": tuple(salary_structures)
+		}))
+
+
+def record_slip_timings(operation, payroll_frequency, timings):
+	"""
+		Fold {salary structure: (slips, seconds)} measured by a run into the recorded seconds per slip, as an
+		exponentially weighted moving average so that the estimate follows structures whose slips get slower.
+		Each structure is one upsert against the unique (operation, salary structure, frequency) index, so
+		workers recording the same structure at once fold into a single row.
+	"""
+	timings = dict((s, t) for s, t in timings.items() if s and t[0])
+	if not timings:
+		return
+
+	weight = get_dispatch_settings().timing_weight
+	for salary_structure, (slips, seconds) in timings.items():
+		frappe.db.sql("""insert into `tabPayroll Slip Timing`
+				(name, creation, modified, owner, modified_by, docstatus,
+					operation, salary_structure, payroll_frequency, seconds_per_slip, samples)
+			values (%(name)s, %(now)s, %(now)s, %(user)s, %(user)s, 0,
+				%(operation)s, %(salary_structure)s, %(payroll_frequency)s, %(sample)s, %(slips)s)
+			on duplicate key update
+				seconds_per_slip = %(weight)s * %(sample)s + (1 - %(weight)s) * seconds_per_slip,
+				samples = samples + %(slips)s,
+				modified = %(now)s""", {
+				"name": frappe.generate_hash("Payroll Slip Timing", 10),
+				"now": now(),
+				"user": frappe.session.user,
+				"operation": operation,
+				"salary_structure": salary_structure,
+				# never null, since a unique index does not compare nulls
+				"payroll_frequency": payroll_frequency or "",
+				"sample": flt(seconds) / slips,
+				"slips": slips,
+				"weight": weight
+			})
+
+
+def get_structure_counts_for_employees(payroll_voucher, employees):
+	"""
+		{salary structure: employees}, by each employee's latest eligible structure for the voucher's period
+	"""
+	if not employees:
+		return {}
+
+	structures = {}
+	for employee, salary_structure in frappe.db.sql("""select employee, salary_structure
+		from `tabPayroll Eligibility`
+		where employee in %(employees)s and effective_from <= %(end_date)s
+			and ifnull(effective_to, '2199-12-31') >= %(start_date)s
+		order by effective_from""", {
+			"employees": tuple(employees),
+			"start_date": payroll_voucher.start_date,
+			"end_date": payroll_voucher.end_date
+		}):
+		# ordered oldest first, so the latest assignment wins
+		structures[employee] = salary_structure
+
+	counts = {}
+	for employee in employees:
+		structure = structures.get(employee)
+		counts[structure] = counts.get(structure, 0) + 1
+	return counts
+
+
+def get_structure_counts_for_slips(salary_slips):
+	"""
+		{salary structure: salary slips}
+	"""
+	if not salary_slips:
+		return {}
+
+	return dict(frappe.db.sql("""select salary_structure, count(*) from `tabSalary Slip`
+		where name in %(salary_slips)s group by salary_structure""", {"salary_slips": tuple(salary_slips)}))
+
+
+class SlipTimer(object):
+	"""
+		collects (slips, seconds) per salary structure while a run works through its slips
+	"""
+	def __init__(self):
+		self.timings = {}
+
+	def add(self, salary_structure, seconds):
+		slips, total = self.timings.get(salary_structure, (0, 0))
+		self.timings[salary_structure] = (slips + 1, total + seconds)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import copy
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cstr
+
+import erpnext.hr.doctype.salary_slip.salary_slip as salary_slip_module
+from erpnext.hr.doctype.salary_slip.salary_slip import SalarySlip
+
+from oi_custom.customizations.payroll import chunk_list
+from oi_custom.customizations.payroll.dispatch import SlipTimer, record_slip_timings
+
+# number of salary slips inserted between two commits when drafting in bulk
+SALARY_SLIP_CHUNK_SIZE = 50
+
+# the only doctypes whose frappe.get_doc lookups the drafter answers from memory while it inserts slips
+PRELOADED_DOCTYPES = ("Salary Structure", "Salary Structure Assignment")
+
+
+class BulkSalarySlipDrafter(object):
+	"""
+		Drafts Salary Slips for many employees at once.
+
+		Left to itself, every Salary Slip insert looks up the employee's salary structure assignment, loads the
+		salary structure (and with it all of its components), resolves the holiday list and its holidays, and
+		finds the payroll period. For a run of several thousand employees these are the same few records over
+		and over again. The drafter loads them in bulk before the first insert, serves the Salary Slip code from
+		memory while the slips are inserted, and commits after every chunk so a large run does not hold one
+		enormous transaction.
+	"""
+	def __init__(self, args, employees, chunk_size=SALARY_SLIP_CHUNK_SIZE):
+		self.args = frappe._dict(args)
+		self.employees = list(employees)
+		self.chunk_size = chunk_size
+
+		self.assignments = {}
+		self.structures = {}
+		self.holiday_lists = {}
+		self.holidays = {}
+		self.payroll_periods = {}
+
+	def run(self, progress=None, commit=False):
+		"""
+			insert a draft Salary Slip for every employee, chunk by chunk; returns the names of the new slips.
+			progress, a PayrollProgress, hears about every slip. The time each slip took is recorded per
+			salary structure for the dispatcher.
+		"""
+		created = []
+		if not self.employees:
+			return created
+
+		timer = SlipTimer()
+		self.load()
+		with self.serve_from_memory():
+			for chunk in chunk_list(self.employees, self.chunk_size):
+				for employee in chunk:
+					start = time.time()
+					ss = frappe.get_doc(dict(self.args, doctype="Salary Slip", employee=employee))
+					ss.insert()
+					timer.add(ss.salary_structure, time.time() - start)
+					created.append(ss.name)
+					if progress:
+						progress.update(len(created))
+
+				if commit:
+					frappe.db.commit()
+
+		record_slip_timings("Create", self.args.payroll_frequency, timer.timings)
+		if commit:
+			frappe.db.commit()
+
+		return created
+
+	########################
+	### bulk preloading ###
+	########################
+	def load(self):
+		self.load_assignments()
+		self.load_structures()
+		self.load_holiday_lists()
+
+	def load_assignments(self):
+		"""
+			latest submitted assignment to an active salary structure for every employee, in one query
+		"""
+		condition = ""
+		if self.args.payroll_frequency:
+			condition = "and ss.payroll_frequency = %(payroll_frequency)s"
+
+		assignments = frappe.db.sql("""
+			select sa.*
+			from `tabSalary Structure Assignment` sa, `tabSalary Structure` ss
+			where sa.salary_structure = ss.name
+				and sa.docstatus = 1 and ss.docstatus = 1 and ss.is_active = 'Yes'
+				and sa.employee in %(employees)s
+				and sa.from_date <= %(end_date)s
+				{condition}
+			order by sa.from_date desc
+		""".format(condition=condition), {
+			"employees": tuple(self.employees),
+			"end_date": self.args.end_date,
+			"payroll_frequency": self.args.payroll_frequency
+		}, as_dict=True)
+
+		for assignment in assignments:
+			# rows are ordered newest first, so the first one seen per employee is the one in force
+			self.assignments.setdefault(assignment.employee, assignment)
+
+	def load_structures(self):
+		"""
+			one Salary Structure (with its earnings and deductions) per distinct structure in the run, kept as
+			plain values so that every slip gets a document of its own
+		"""
+		for name in set(a.salary_structure for a in self.assignments.values()):
+			self.structures[name] = frappe.get_doc("Salary Structure", name).as_dict()
+
+	def load_holiday_lists(self):
+		"""
+			holiday list of every employee, falling back to the company default, in one query
+		"""
+		rows = frappe.db.sql("""
+			select emp.name, ifnull(emp.holiday_list, company.default_holiday_list) as holiday_list
+			from `tabEmployee` emp left join `tabCompany` company on company.name = emp.company
+			where emp.name in %(employees)s
+		""", {"employees": tuple(self.employees)}, as_dict=True)
+
+		for row in rows:
+			if row.holiday_list:
+				self.holiday_lists[row.name] = row.holiday_list
+
+	#################################
+	### serving the Salary Slips ###
+	#################################
+	def serve_from_memory(self):
+		return _PreloadedSalarySlipInputs(self)
+
+	def check_sal_struct(self, original, slip, joining_date, relieving_date):
+		assignment = self.assignments.get(slip.employee)
+		if not assignment:
+			return original(slip, joining_date, relieving_date)
+
+		slip.salary_structure = assignment.salary_structure
+		return slip.salary_structure
+
+	def get_holidays_for_employee(self, original, slip, start_date, end_date):
+		holiday_list = self.holiday_lists.get(slip.employee)
+		if not holiday_list:
+			return original(slip, start_date, end_date)
+
+		key = (holiday_list, cstr(start_date), cstr(end_date))
+		if key not in self.holidays:
+			self.holidays[key] = [cstr(d) for d in frappe.db.sql_list("""select holiday_date from `tabHoliday`
+				where parent=%s and holiday_date >= %s and holiday_date <= %s""", key)]
+
+		return list(self.holidays[key])
+
+	def get_holiday_list_for_employee(self, original, employee, raise_exception=True):
+		return self.holiday_lists.get(employee) or original(employee, raise_exception)
+
+	def get_payroll_period(self, original, *args, **kwargs):
+		key = (tuple(cstr(a) for a in args), tuple(sorted((k, cstr(v)) for k, v in kwargs.items())))
+		if key not in self.payroll_periods:
+			self.payroll_periods[key] = original(*args, **kwargs)
+		return self.payroll_periods[key]
+
+	def get_doc(self, original, *args, **kwargs):
+		"""
+			Answer frappe.get_doc(doctype, name) for the preloaded doctypes with a new document built from the
+			preloaded values, so that nothing a slip does to it reaches the next slip or any other caller.
+			Every other call goes to frappe.get_doc unchanged.
+		"""
+		if len(args) == 2 and not kwargs and args[0] in PRELOADED_DOCTYPES:
+			doctype, name = args
+			if doctype == "Salary Structure" and name in self.structures:
+				return original(copy.deepcopy(self.structures[name]))
+
+			if doctype == "Salary Structure Assignment" and isinstance(name, dict):
+				assignment = self.assignments.get(name.get("employee"))
+				if assignment and set(name.keys()) == set(["employee", "salary_structure"]) \
+					and assignment.salary_structure == name.get("salary_structure"):
+						return original(dict(assignment, doctype="Salary Structure Assignment"))
+
+		return original(*args, **kwargs)
+
+
+class _PreloadedSalarySlipInputs(object):
+	"""
+		context manager that points the Salary Slip lookups at a BulkSalarySlipDrafter for the duration of
+		a bulk insert and puts the originals back afterwards. frappe.get_doc is only answered from memory for
+		PRELOADED_DOCTYPES, and always with a fresh document.
+	"""
+	def __init__(self, drafter):
+		self.drafter = drafter
+		self.restore = []
+
+	def __enter__(self):
+		drafter = self.drafter
+
+		self.patch(SalarySlip, "check_sal_struct", lambda original: lambda slip, joining_date, relieving_date:
+			drafter.check_sal_struct(original, slip, joining_date, relieving_date))
+		self.patch(SalarySlip, "get_holidays_for_employee", lambda original: lambda slip, start_date, end_date:
+			drafter.get_holidays_for_employee(original, slip, start_date, end_date))
+		self.patch(salary_slip_module, "get_holiday_list_for_employee", lambda original: lambda employee, raise_exception=True:
+			drafter.get_holiday_list_for_employee(original, employee, raise_exception))
+		self.patch(salary_slip_module, "get_payroll_period", lambda original: lambda *args, **kwargs:
+			drafter.get_payroll_period(original, *args, **kwargs))
+		self.patch(frappe, "get_doc", lambda original: lambda *args, **kwargs:
+			drafter.get_doc(original, *args, **kwargs))
+		return drafter
+
+	def __exit__(self, *exc_info):
+		for owner, attribute, original in reversed(self.restore):
+			setattr(owner, attribute, original)
+		self.restore = []
+
+	def patch(self, owner, attribute, make_replacement):
+		# not every ERPNext version has every lookup; leave the missing ones alone
+		if not hasattr(owner, attribute):
+			return
+		original = getattr(owner, attribute)
+		self.restore.append((owner, attribute, original))
+		setattr(owner, attribute, make_replacement(original))
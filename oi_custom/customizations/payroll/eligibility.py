@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import cint, now
+
+
+def get_eligible_employees(payroll_voucher):
+	"""
+		The employees a Payroll Voucher pays, read from the Payroll Eligibility index in one range query on
+		(company, effective_from). Matches PayrollEntry.get_emp_list: an employee qualifies through any submitted
+		assignment, started by the end of the period, to an active structure of the company with the voucher's
+		frequency and timesheet setting, as long as they joined by the end of the period and were not relieved
+		before its start.
+	"""
+	conditions = []
+	values = {
+		"company": payroll_voucher.company,
+		"start_date": payroll_voucher.start_date,
+		"end_date": payroll_voucher.end_date,
+		"salary_slip_based_on_timesheet": cint(payroll_voucher.salary_slip_based_on_timesheet)
+	}
+	for f in ("payroll_frequency", "branch", "department", "designation"):
+		if payroll_voucher.get(f):
+			conditions.append("and {0} = %({0})s".format(f))
+			values[f] = payroll_voucher.get(f)
+
+	return frappe.db.sql("""
+		select employee, employee_name, department, designation
+		from `tabPayroll Eligibility`
+		where company = %(company)s
+			and effective_from <= %(end_date)s
+			and ifnull(effective_to, '2199-12-31') >= %(start_date)s
+			and salary_slip_based_on_timesheet = %(salary_slip_based_on_timesheet)s
+			{conditions}
+		group by employee, employee_name, department, designation
+		order by max(effective_from) desc""".format(conditions=" ".join(conditions)), values, as_dict=True)
+
+
+def rebuild_payroll_eligibility(employees=None, salary_structures=None):
+	"""
+		Rewrite the index rows of the given employees or salary structures from their submitted assignments,
+		or the whole index when neither is given. An assignment is indexed when its structure is submitted,
+		active and belongs to the employee's company; it takes effect from the later of its own start and the
+		employee's joining date, and ends when the employee is relieved.
+	"""
+	condition, values = "", {"now": now(), "user": frappe.session.user}
+	if employees:
+		condition, values["employees"] = "employee in %(employees)s", tuple(employees)
+	elif salary_structures:
+		condition, values["salary_structures"] = "salary_structure in %(salary_structures)s", tuple(salary_structures)
+
+	frappe.db.sql("""delete from `tabPayroll Eligibility` {0}""".format(
+		"where " + condition if condition else ""), values)
+
+	frappe.db.sql("""
+		insert into `tabPayroll Eligibility` (name, creation, modified, modified_by, owner, docstatus, idx,
+			employee, employee_name, company, branch, department, designation, salary_structure,
+			payroll_frequency, salary_slip_based_on_timesheet, effective_from, effective_to)
+		select ssa.name, %(now)s, %(now)s, %(user)s, %(user)s, 0, 0,
+			emp.name, emp.employee_name, emp.company, emp.branch, emp.department, emp.designation, ss.name,
+			ss.payroll_frequency, ifnull(ss.salary_slip_based_on_timesheet, 0),
+			greatest(ssa.from_date, ifnull(emp.date_of_joining, ssa.from_date)), emp.relieving_date
+		from `tabSalary Structure Assignment` ssa
+			inner join `tabEmployee` emp on emp.name = ssa.employee
+			inner join `tabSalary Structure` ss on ss.name = ssa.salary_structure
+		where ssa.docstatus = 1 and ss.docstatus = 1 and ss.is_active = 'Yes' and ss.company = emp.company
+			{0}""".format("and ssa." + condition if condition else ""), values)
+
+
+def update_employee_eligibility(doc, method=None):
+	"""
+		doc_events hook for Employee and Salary Structure Assignment
+	"""
+	rebuild_payroll_eligibility(employees=[doc.name if doc.doctype == "Employee" else doc.employee])
+
+
+def remove_employee_eligibility(doc, method=None):
+	"""
+		doc_events hook: an employee being deleted leaves the index
+	"""
+	frappe.db.sql("""delete from `tabPayroll Eligibility` where employee = %s""", doc.name)
+
+
+def update_salary_structure_eligibility(doc, method=None):
+	"""
+		doc_events hook for Salary Structure: submitting, cancelling or (de)activating it changes who it covers
+	"""
+	rebuild_payroll_eligibility(salary_structures=[doc.name])
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+from multiprocessing import Pool
+
+import frappe
+from frappe import _
+from frappe.utils import add_to_date, now_datetime
+
+from oi_custom.customizations.payroll import chunk_list
+
+# processes rendering salary slip PDFs for one voucher
+EMAIL_RENDER_PROCESSES = 4
+
+# emails handed to the email queue together, and the seconds between two batches going out
+EMAIL_BATCH_SIZE = 50
+EMAIL_BATCH_INTERVAL = 60
+
+# print format the render workers use; set when each worker starts
+render_print_format = None
+
+
+def enqueue_salary_slip_emails(payroll_voucher, salary_slips):
+	"""
+		Record one Salary Slip Email per submitted slip and leave the rendering and sending to a background
+		job, so submitting a voucher does not wait for its PDFs. Slips that already have a record (a voucher
+		resubmitted after an interruption) are not emailed twice. Does nothing unless HR Settings asks for
+		salary slips to be emailed.
+	"""
+	if not frappe.db.get_single_value("HR Settings", "email_salary_slip_to_employee") or not salary_slips:
+		return
+
+	recorded = set(frappe.db.sql_list("""select salary_slip from `tabSalary Slip Email`
+		where payroll_voucher = %s""", payroll_voucher))
+
+	for batch in chunk_list([ss for ss in salary_slips if ss not in recorded], 1000):
+		for ss in frappe.db.sql("""select ss.name, ss.employee, ss.employee_name, emp.prefered_email
+			from `tabSalary Slip` ss left join `tabEmployee` emp on emp.name = ss.employee
+			where ss.name in %(salary_slips)s""", {"salary_slips": tuple(batch)}, as_dict=True):
+			email = frappe.new_doc("Salary Slip Email")
+			email.update({
+				"salary_slip": ss.name,
+				"payroll_voucher": payroll_voucher,
+				"employee": ss.employee,
+				"employee_name": ss.employee_name,
+				"recipient": ss.prefered_email,
+				"status": "Pending" if ss.prefered_email else "No Recipient"
+			})
+			email.db_insert()
+
+	frappe.enqueue(send_salary_slip_emails, queue="long", timeout=7200, enqueue_after_commit=True,
+		payroll_voucher=payroll_voucher)
+
+
+def send_salary_slip_emails(payroll_voucher):
+	"""
+		Render the voucher's pending salary slips in a pool of processes and queue their emails in batches of
+		EMAIL_BATCH_SIZE, each batch due EMAIL_BATCH_INTERVAL seconds after the previous one, so the mail
+		server sees a steady trickle rather than the whole payroll at once. Each batch is committed on its own.
+	"""
+	print_format = frappe.get_meta("Salary Slip").default_print_format or "Standard"
+	pool = Pool(EMAIL_RENDER_PROCESSES, init_render_worker,
+		(frappe.local.site, frappe.local.sites_path, frappe.session.user, print_format))
+
+	try:
+		batch_number = 0
+		while True:
+			batch = frappe.get_all("Salary Slip Email", fields=["name", "salary_slip", "recipient"],
+				filters={"payroll_voucher": payroll_voucher, "status": "Pending"},
+				order_by="creation", limit_page_length=EMAIL_BATCH_SIZE)
+			if not batch:
+				break
+
+			emails = dict((d.salary_slip, d) for d in batch)
+			periods = dict((d.name, d) for d in frappe.get_all("Salary Slip", fields=["name", "start_date", "end_date"],
+				filters={"name": ("in", list(emails))}))
+			send_after = add_to_date(now_datetime(), seconds=batch_number * EMAIL_BATCH_INTERVAL)
+
+			for salary_slip, pdf, error in pool.imap_unordered(render_salary_slip_pdf, list(emails)):
+				email = emails[salary_slip]
+				if error:
+					frappe.db.set_value("Salary Slip Email", email.name, {"status": "Error", "error": error})
+					continue
+
+				period = periods[salary_slip]
+				frappe.sendmail(
+					recipients=[email.recipient],
+					subject=_("Salary Slip - from {0} to {1}").format(period.start_date, period.end_date),
+					message=_("Please see attachment"),
+					attachments=[{"fname": salary_slip + ".pdf", "fcontent": pdf}],
+					reference_doctype="Salary Slip",
+					reference_name=salary_slip,
+					send_after=send_after
+				)
+				frappe.db.set_value("Salary Slip Email", email.name, {"status": "Queued", "send_after": send_after})
+
+			frappe.db.commit()
+			batch_number += 1
+
+		pool.close()
+	except Exception:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+
+def init_render_worker(site, sites_path, user, print_format):
+	"""
+		Give a pool process its own site connection. Print formats are jinja templates compiled from their
+		HTML on every render; the worker keeps each compiled template for as long as it lives.
+	"""
+	global render_print_format
+
+	# the connection inherited from the job belongs to it: closing it here would send COM_QUIT down the job's
+	# own socket, so the handle is dropped without being closed before the worker's state is torn down
+	frappe.local.db = None
+	frappe.destroy()
+	frappe.init(site=site, sites_path=sites_path)
+	frappe.connect()
+	frappe.set_user(user)
+	render_print_format = print_format
+
+	jenv = frappe.get_jenv()
+	from_string = jenv.from_string
+	templates = {}
+
+	def cached_from_string(source, *args, **kwargs):
+		if args or kwargs:
+			return from_string(source, *args, **kwargs)
+		if source not in templates:
+			templates[source] = from_string(source)
+		return templates[source]
+
+	# shadows Environment.from_string on this worker's environment only
+	jenv.from_string = cached_from_string
+
+
+def render_salary_slip_pdf(salary_slip):
+	"""
+		runs in a pool process: (salary slip, PDF, None), or (salary slip, None, traceback) if it failed
+	"""
+	try:
+		return salary_slip, frappe.get_print("Salary Slip", salary_slip, render_print_format, as_pdf=True), None
+	except Exception:
+		return salary_slip, None, frappe.get_traceback()
+	finally:
+		frappe.db.rollback()
+
+
+def update_salary_slip_email_status():
+	"""
+		scheduler_events hourly task: carry the email queue's outcome over to the queued Salary Slip Emails
+	"""
+	frappe.db.sql("""update `tabSalary Slip Email` sse
+			inner join `tabEmail Queue` eq on eq.reference_doctype = 'Salary Slip'
+				and eq.reference_name = sse.salary_slip and eq.creation >= sse.creation
+		set sse.status = if(eq.status = 'Sent', 'Sent', 'Error'), sse.error = eq.error
+		where sse.status = 'Queued' and eq.status in ('Sent', 'Error', 'Expired')""")
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import math
+
+import frappe
+import erpnext
+from collections import OrderedDict
+from frappe import _
+from frappe.utils import flt, cstr, getdate, now
+from frappe.model.meta import get_field_precision
+
+from erpnext.accounts.utils import get_fiscal_year
+from erpnext.accounts.party import validate_party_frozen_disabled, validate_party_gle_currency
+from erpnext.accounts.general_ledger import process_gl_map
+from erpnext.accounts.doctype.gl_entry.gl_entry import check_freezing_date, validate_balance_type, \
+	validate_frozen_account
+from erpnext.accounts.doctype.budget.budget import validate_expense_against_budget
+
+# rows written by one multi-row insert into `tabGL Entry`
+GL_INSERT_BATCH_SIZE = 500
+
+
+def make_bulk_gl_entries(gl_map, adv_adj=False, merge_entries=True):
+	"""
+		Post a payroll GL map without creating one GL Entry document per line. The checks that each GL Entry
+		would run for itself (balance, accounts and their currencies, cost centers, parties, frozen accounts and
+		dates, closed periods, budgets) run once over the whole map, batched by distinct account, cost center and
+		party, and the rows are then written with batched multi-row inserts. The balance type of each account
+		is checked once the rows are in, as GL Entry does after its insert.
+
+		Payroll lines are booked against Salary Slips, which carry no outstanding amount, so there is nothing to
+		update on the referenced documents afterwards.
+	"""
+	if not gl_map:
+		return
+
+	if merge_entries:
+		gl_map = merge_similar_gl_entries(gl_map)
+	gl_map = process_gl_map(gl_map, merge_entries=False)
+	if not gl_map:
+		return
+
+	validate_gl_map(gl_map, adv_adj)
+	insert_gl_entries(gl_map)
+
+	for account in set(entry.account for entry in gl_map):
+		validate_balance_type(account, adv_adj)
+
+
+def merge_similar_gl_entries(gl_map):
+	"""
+		Same result as erpnext.accounts.general_ledger.merge_similar_entries, in one pass. The stock merge
+		compares every entry with all the entries kept so far, which is quadratic on per-employee maps; here
+		the entries are grouped on their composite key in a dict instead. The first entry seen for a key
+		absorbs the amounts of the later ones, kept entries stay in first-seen order, and entries that net
+		to zero are dropped.
+	"""
+	merged = OrderedDict()
+	for entry in gl_map:
+		key = get_merge_key(entry)
+		same_head = merged.get(key)
+		if same_head:
+			same_head.debit = flt(same_head.debit) + flt(entry.debit)
+			same_head.debit_in_account_currency = \
+				flt(same_head.debit_in_account_currency) + flt(entry.debit_in_account_currency)
+			same_head.credit = flt(same_head.credit) + flt(entry.credit)
+			same_head.credit_in_account_currency = \
+				flt(same_head.credit_in_account_currency) + flt(entry.credit_in_account_currency)
+		else:
+			merged[key] = entry
+
+	return [entry for entry in merged.values() if flt(entry.debit, 9) != 0 or flt(entry.credit, 9) != 0]
+
+
+def get_merge_key(entry):
+	return (entry.account, cstr(entry.get('party_type')), cstr(entry.get('party')),
+		cstr(entry.get('against_voucher')), cstr(entry.get('against_voucher_type')),
+		cstr(entry.get('cost_center')), cstr(entry.get('project')))
+
+
+def validate_gl_map(gl_map, adv_adj=False):
+	first = gl_map[0]
+	company, posting_date = first.company, first.posting_date
+
+	validate_mandatory(gl_map)
+	validate_balance(gl_map)
+	accounts = validate_accounts(gl_map, adv_adj)
+	validate_cost_centers(gl_map)
+	validate_parties(gl_map)
+	check_freezing_date(posting_date, adv_adj)
+	validate_closed_period(company, posting_date)
+
+	# budgets are kept against expense accounts, of which a payroll map only has a handful
+	for entry in gl_map:
+		if accounts[entry.account].report_type == "Profit and Loss":
+			validate_expense_against_budget(entry)
+
+
+def validate_mandatory(gl_map):
+	for entry in gl_map:
+		for k in ["account", "voucher_type", "voucher_no", "posting_date", "company"]:
+			if not entry.get(k):
+				frappe.throw(_("{0} is required").format(frappe.get_meta("GL Entry").get_label(k)))
+
+
+def validate_balance(gl_map):
+	"""
+		the map must balance to the smallest unit of the company currency, added up as integers
+	"""
+	first = gl_map[0]
+	precision = get_currency_precision(first.company)
+	scale = 10 ** precision
+
+	diff_units = 0
+	for entry in gl_map:
+		diff_units += to_minor_units(entry.debit, scale) - to_minor_units(entry.credit, scale)
+
+	debit_credit_diff = flt(diff_units / float(scale), precision)
+	if diff_units:
+		frappe.throw(_("Debit and Credit not equal for {0} #{1}. Difference is {2}.")
+			.format(first.voucher_type, first.voucher_no, debit_credit_diff))
+
+
+def get_currency_precision(company):
+	"""
+		decimal places of GL Entry amounts in the company's currency
+	"""
+	return get_field_precision(frappe.get_meta("GL Entry").get_field("debit"),
+		currency=frappe.db.get_value("Company", company, "default_currency", cache=True))
+
+
+def to_minor_units(amount, scale):
+	"""
+		Amount as a whole number of the currency's smallest unit (cents, for a precision of 2, i.e. a scale of
+		100). Amounts kept this way add up exactly. Rounds as frappe.utils.rounded does: for a non-zero
+		precision exact halves go up towards positive infinity (0.125 -> 13, -0.125 -> -12); for a currency
+		without decimals (a scale of 1) they go to the even neighbour (2.5 -> 2, 3.5 -> 4). Anything else goes
+		to the nearest unit.
+	"""
+	units = round((amount or 0) * scale, 8)
+	floor = math.floor(units)
+	if units - floor == 0.5:
+		if scale == 1:
+			return int(floor) if floor % 2 == 0 else int(floor) + 1
+		return int(floor) + 1
+	return int(round(units))
+
+
+def validate_accounts(gl_map, adv_adj=False):
+	"""
+		check every account used by the map with a single query; returns the account details by name
+	"""
+	first = gl_map[0]
+	company_currency = erpnext.get_company_currency(first.company)
+	accounts = {}
+	for d in frappe.db.sql("""select name, is_group, freeze_account, company, report_type, account_type,
+			account_currency
+		from `tabAccount` where name in %(accounts)s""",
+		{"accounts": tuple(set(entry.account for entry in gl_map))}, as_dict=True):
+			accounts[d.name] = d
+
+	frozen_accounts_modifier = frappe.db.get_value('Accounts Settings', None, 'frozen_accounts_modifier')
+	for entry in gl_map:
+		account = accounts.get(entry.account)
+		if not account:
+			frappe.throw(_("Account {0} does not exist").format(entry.account))
+
+		if account.is_group:
+			frappe.throw(_("{0} {1}: Account {2} cannot be a Group")
+				.format(first.voucher_type, first.voucher_no, entry.account))
+
+		if account.company != first.company:
+			frappe.throw(_("{0} {1}: Account {2} does not belong to Company {3}")
+				.format(first.voucher_type, first.voucher_no, entry.account, first.company))
+
+		if account.freeze_account == "Yes" and not adv_adj \
+			and frozen_accounts_modifier not in frappe.get_roles():
+				frappe.throw(_("Account {0} is frozen").format(entry.account))
+
+		if account.report_type == "Profit and Loss" and not entry.cost_center:
+			frappe.throw(_("{0} {1}: Cost Center is required for 'Profit and Loss' account {2}. Please set up a default Cost Center for the Company.")
+				.format(first.voucher_type, first.voucher_no, entry.account))
+
+		if account.account_type in ("Receivable", "Payable") and not (entry.party_type and entry.party):
+			frappe.throw(_("{0} {1}: Party Type and Party is required for Receivable / Payable account {2}")
+				.format(first.voucher_type, first.voucher_no, entry.account))
+
+		if not entry.get("account_currency"):
+			entry.account_currency = company_currency
+		if entry.account_currency != (account.account_currency or company_currency):
+			frappe.throw(_("{0} {1}: Accounting Entry for {2} can only be made in currency: {3}")
+				.format(first.voucher_type, first.voucher_no, entry.account,
+					account.account_currency or company_currency))
+
+	return accounts
+
+
+def validate_cost_centers(gl_map):
+	"""
+		every cost center used by the map must belong to the company and not be a group; one query for all
+	"""
+	first = gl_map[0]
+	cost_centers = set(entry.cost_center for entry in gl_map if entry.get("cost_center"))
+	if not cost_centers:
+		return
+
+	details = {}
+	for d in frappe.db.sql("""select name, company, is_group from `tabCost Center` where name in %(cost_centers)s""",
+		{"cost_centers": tuple(cost_centers)}, as_dict=True):
+			details[d.name] = d
+
+	for cost_center in cost_centers:
+		cost_center_details = details.get(cost_center) or frappe._dict()
+		if cost_center_details.company != first.company:
+			frappe.throw(_("{0} {1}: Cost Center {2} does not belong to Company {3}")
+				.format(first.voucher_type, first.voucher_no, cost_center, first.company))
+
+		if cost_center_details.is_group:
+			frappe.throw(_("{0} {1}: Cost Center {2} is a group cost center and group cost centers cannot be used in transactions")
+				.format(first.voucher_type, first.voucher_no, cost_center))
+
+
+def validate_parties(gl_map):
+	"""
+		the frozen / disabled and currency checks of every party in the map, once per party and currency
+	"""
+	first = gl_map[0]
+	parties = set((entry.party_type, entry.party, entry.account_currency) for entry in gl_map
+		if entry.get("party_type") and entry.get("party"))
+
+	for party_type, party in set((party_type, party) for party_type, party, currency in parties):
+		validate_party_frozen_disabled(party_type, party)
+
+	for party_type, party, account_currency in parties:
+		validate_party_gle_currency(party_type, party, first.company, account_currency)
+
+
+def validate_closed_period(company, posting_date):
+	"""
+		no entries on or before the last submitted Period Closing Voucher of the company
+	"""
+	closed_upto = frappe.db.sql("""select max(posting_date) from `tabPeriod Closing Voucher`
+		where company = %s and docstatus = 1""", company)[0][0]
+	if closed_upto and getdate(posting_date) <= getdate(closed_upto):
+		frappe.throw(_("Posting Date {0} falls in a period that has been closed up to {1}")
+			.format(frappe.format(posting_date, "Date"), frappe.format(closed_upto, "Date")))
+
+
+def insert_gl_entries(gl_map, batch_size=GL_INSERT_BATCH_SIZE):
+	"""
+		write submitted GL Entry rows with multi-row inserts, batch_size rows per statement
+	"""
+	first = gl_map[0]
+	fiscal_year = get_fiscal_year(first.posting_date, company=first.company)[0]
+	columns = frappe.get_meta("GL Entry").get_valid_columns()
+
+	timestamp = now()
+	rows = []
+	for entry in gl_map:
+		gle = frappe.new_doc("GL Entry")
+		gle.update(entry)
+		gle.update({
+			"name": frappe.generate_hash(length=10),
+			"owner": frappe.session.user,
+			"modified_by": frappe.session.user,
+			"creation": timestamp,
+			"modified": timestamp,
+			"docstatus": 1,
+			"fiscal_year": entry.get("fiscal_year") or fiscal_year,
+			"is_opening": entry.get("is_opening") or "No"
+		})
+		# get_valid_dict applies the same defaults and type coercion as a regular GL Entry insert
+		values = gle.get_valid_dict()
+		rows.append([values.get(c) for c in columns])
+
+	placeholder = "(" + ", ".join(["%s"] * len(columns)) + ")"
+	for start in range(0, len(rows), batch_size):
+		batch = rows[start:start + batch_size]
+		frappe.db.sql("""insert into `tabGL Entry` ({columns}) values {values}""".format(
+			columns=", ".join("`{0}`".format(c) for c in columns),
+			values=", ".join([placeholder] * len(batch))
+		), tuple(value for row in batch for value in row))
+
+
+def validate_gl_cancellation(company, posting_date, adv_adj=False):
+	"""
+		the period checks a voucher's GL Entries must pass before they are reversed; vouchers cancelled in the
+		background run them while cancelling, so that a closed or frozen period is refused to the user at once
+	"""
+	check_freezing_date(posting_date, adv_adj)
+	validate_closed_period(company, posting_date)
+
+
+def cancel_bulk_gl_entries(voucher_type, voucher_no, adv_adj=False):
+	"""
+		Reverse all GL Entries of a voucher with a single delete. The checks that make_gl_entries(cancel=True)
+		runs for every entry run once per account instead. Deleting is idempotent, so an interrupted
+		cancellation can safely run this again.
+	"""
+	gl_entries = frappe.db.sql("""select gle.account, gle.posting_date, gle.company, gle.cost_center,
+			gle.debit, gle.credit, gle.voucher_type, gle.voucher_no, acc.report_type
+		from `tabGL Entry` gle left join `tabAccount` acc on acc.name = gle.account
+		where gle.voucher_type = %s and gle.voucher_no = %s""", (voucher_type, voucher_no), as_dict=True)
+	if not gl_entries:
+		return
+
+	validate_gl_cancellation(gl_entries[0].company, gl_entries[0].posting_date, adv_adj)
+
+	frappe.db.sql("""delete from `tabGL Entry` where voucher_type = %s and voucher_no = %s""",
+		(voucher_type, voucher_no))
+
+	for account in set(entry.account for entry in gl_entries):
+		validate_frozen_account(account, adv_adj)
+		validate_balance_type(account, adv_adj)
+
+	if not adv_adj:
+		for entry in gl_entries:
+			if entry.report_type == "Profit and Loss":
+				validate_expense_against_budget(entry)
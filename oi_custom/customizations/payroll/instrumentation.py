@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import resource
+import time
+
+import frappe
+from frappe.utils import now, flt
+
+
+class PayrollPhase(object):
+	"""
+		Measure one phase of a Payroll Voucher run and record it on the voucher's open Payroll Voucher Run Log:
+
+			with PayrollPhase(self.name, "Submit"):
+				...
+
+		Wall time, the number of SQL queries, the rows they returned or changed, and how much the phase raised
+		the process' peak memory are recorded. Phases may nest (submitting the last chunk posts the ledger); queries count towards every
+		phase they run in. A phase that raises is not recorded, since its work is rolled back anyway, and
+		nothing is recorded for vouchers that have not been saved yet.
+	"""
+	def __init__(self, payroll_voucher, phase):
+		self.payroll_voucher = payroll_voucher
+		self.phase = phase
+		self.queries = 0
+		self.rows_touched = 0
+
+	def __enter__(self):
+		self.started = now()
+		self.start = time.time()
+		self.start_peak_memory = get_peak_memory()
+		start_counting(self)
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		stop_counting(self)
+		if exc_type is None and self.payroll_voucher and frappe.db.exists("Payroll Voucher", self.payroll_voucher):
+			record_phase(self.payroll_voucher, {
+				"phase": self.phase,
+				"started": self.started,
+				"seconds": time.time() - self.start,
+				"queries": self.queries,
+				"rows_touched": self.rows_touched,
+				"peak_memory": flt(get_peak_memory() - self.start_peak_memory, 1)
+			})
+
+
+def start_counting(phase):
+	"""
+		route frappe.db.sql through a counter for as long as any phase is open
+	"""
+	phases = getattr(frappe.local, "payroll_phases", None)
+	if not phases:
+		phases = frappe.local.payroll_phases = []
+		db = frappe.db
+		sql = db.sql
+
+		def counted_sql(*args, **kwargs):
+			result = sql(*args, **kwargs)
+			rows = max(db._cursor.rowcount, 0) if db._cursor else 0
+			for open_phase in frappe.local.payroll_phases:
+				open_phase.queries += 1
+				open_phase.rows_touched += rows
+			return result
+
+		# shadows Database.sql on this connection only; deleting the attribute restores it
+		db.sql = counted_sql
+		frappe.local.payroll_phases_db = db
+
+	phases.append(phase)
+
+
+def stop_counting(phase):
+	phases = frappe.local.payroll_phases
+	phases.remove(phase)
+	if not phases:
+		del frappe.local.payroll_phases_db.sql
+		frappe.local.payroll_phases_db = None
+
+
+def get_peak_memory():
+	"""
+		high-water mark of the process' resident memory since it started, in MB (ru_maxrss is in kilobytes on
+		Linux); a phase records how much it raised this, since a long-lived worker's mark mostly reflects
+		earlier jobs
+	"""
+	return flt(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+
+def record_phase(payroll_voucher, measurements):
+	"""
+		add the phase to the run log and its totals. The phase row is inserted on its own and the totals are
+		updated in SQL, so phases finishing on several workers at once do not overwrite each other.
+	"""
+	# the bookkeeping queries below should not count towards any phase that is still open
+	open_phases, frappe.local.payroll_phases = frappe.local.payroll_phases, []
+	try:
+		run_log = get_open_run_log(payroll_voucher)
+		idx = frappe.db.sql("""select ifnull(max(idx), 0) from `tabPayroll Voucher Run Phase`
+			where parent = %s""", run_log)[0][0]
+
+		row = frappe.new_doc("Payroll Voucher Run Phase")
+		row.update(measurements)
+		row.update({
+			"parent": run_log,
+			"parenttype": "Payroll Voucher Run Log",
+			"parentfield": "phases",
+			"idx": idx + 1
+		})
+		row.db_insert()
+
+		frappe.db.sql("""update `tabPayroll Voucher Run Log`
+			set total_seconds = ifnull(total_seconds, 0) + %(seconds)s,
+				total_queries = ifnull(total_queries, 0) + %(queries)s,
+				total_rows_touched = ifnull(total_rows_touched, 0) + %(rows_touched)s,
+				peak_memory = greatest(ifnull(peak_memory, 0), %(peak_memory)s)
+			where name = %(run_log)s""", dict(measurements, run_log=run_log))
+	finally:
+		frappe.local.payroll_phases = open_phases
+
+
+def get_open_run_log(payroll_voucher):
+	"""
+		the voucher's run log that is still collecting phases, started if there is none
+	"""
+	run_log = frappe.db.get_value("Payroll Voucher Run Log",
+		{"payroll_voucher": payroll_voucher, "status": "Open"}, "name", order_by="creation desc")
+	if run_log:
+		return run_log
+
+	run_log = frappe.get_doc({
+		"doctype": "Payroll Voucher Run Log",
+		"payroll_voucher": payroll_voucher,
+		"status": "Open",
+		"started": now()
+	})
+	run_log.flags.ignore_permissions = True
+	run_log.insert()
+	return run_log.name
+
+
+def close_run_log(payroll_voucher):
+	"""
+		end the voucher's current run; the next phase recorded for it starts a new run log
+	"""
+	frappe.db.sql("""update `tabPayroll Voucher Run Log` set status = 'Closed', finished = %s
+		where payroll_voucher = %s and status = 'Open'""", (now(), payroll_voucher))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe import _
+
+from oi_custom.customizations.payroll.general_ledger import get_currency_precision
+
+
+class PayrollLookups(object):
+	"""
+		The Accounts and Salary Component Accounts a Payroll Voucher needs while it builds its ledger entries.
+		Everything is loaded for the company in two bulk queries when the run starts and served from memory
+		for the rest of it; a run never sees master data older than its own start.
+	"""
+	def __init__(self, company):
+		self.company = company
+		self.minor_unit_scale = None
+
+		self.component_accounts = dict(frappe.db.sql("""select parent, default_account
+			from `tabSalary Component Account` where company = %s""", company))
+
+		self.accounts = {}
+		for d in frappe.db.sql("""select name, account_type, account_currency
+			from `tabAccount` where company = %s and is_group = 0""", company, as_dict=True):
+				self.accounts[d.name] = d
+
+	def get_salary_component_account(self, salary_component):
+		account = self.component_accounts.get(salary_component)
+		if not account:
+			frappe.throw(_("Please set default account in Salary Component {0}")
+				.format(salary_component))
+		return account
+
+	def get_account(self, account):
+		if account not in self.accounts:
+			# not a ledger of this company (e.g. a loan account set up elsewhere); look it up on its own
+			self.accounts[account] = frappe.db.get_value("Account", account,
+				["name", "account_type", "account_currency"], as_dict=True) or frappe._dict()
+		return self.accounts[account]
+
+	def is_payable(self, account):
+		return self.get_account(account).account_type == "Payable"
+
+	def get_minor_unit_scale(self):
+		"""
+			smallest units per unit of the company currency (100 for a precision of 2)
+		"""
+		if self.minor_unit_scale is None:
+			self.minor_unit_scale = 10 ** get_currency_precision(self.company)
+		return self.minor_unit_scale
+
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import json
+from six import string_types
+
+import frappe
+from frappe import _
+from frappe.utils import cint, now
+
+# vouchers with more salary slip rows than this are sent to the form without them, and paged instead
+SALARY_SLIP_PAGING_THRESHOLD = 500
+SALARY_SLIP_PAGE_LENGTH = 100
+
+# the row fields the form may change through update_salary_slip_rows
+EDITABLE_SALARY_SLIP_FIELDS = ("employee", "employee_name", "salary_slip")
+
+
+@frappe.whitelist()
+def get_salary_slip_page(payroll_voucher, start=0, page_length=SALARY_SLIP_PAGE_LENGTH):
+	"""
+		one page of the voucher's salary slip rows, in table order
+	"""
+	frappe.has_permission("Payroll Voucher", "read", payroll_voucher, throw=True)
+	page_length = min(cint(page_length) or SALARY_SLIP_PAGE_LENGTH, SALARY_SLIP_PAGE_LENGTH)
+
+	return frappe.db.sql("""select detail.name, detail.idx, detail.employee, detail.employee_name,
+			detail.salary_slip, ss.docstatus as salary_slip_status, ss.net_pay
+		from `tabPayroll Salary Slip Detail` detail
+			left join `tabSalary Slip` ss on ss.name = detail.salary_slip
+		where detail.parent = %s and detail.parenttype = 'Payroll Voucher' and detail.parentfield = 'salary_slips'
+		order by detail.idx
+		limit %s, %s""", (payroll_voucher, cint(start), page_length), as_dict=True)
+
+
+@frappe.whitelist()
+def get_salary_slip_totals(payroll_voucher):
+	"""
+		row, slip and pay totals over the whole salary slip table, so the form does not need every row
+	"""
+	frappe.has_permission("Payroll Voucher", "read", payroll_voucher, throw=True)
+
+	return frappe.db.sql("""select count(*) as total_rows, count(detail.salary_slip) as salary_slips,
+			ifnull(sum(ss.docstatus = 0), 0) as draft_salary_slips,
+			ifnull(sum(ss.docstatus = 1), 0) as submitted_salary_slips,
+			ifnull(sum(ss.gross_pay), 0) as gross_pay, ifnull(sum(ss.net_pay), 0) as net_pay
+		from `tabPayroll Salary Slip Detail` detail
+			left join `tabSalary Slip` ss on ss.name = detail.salary_slip
+		where detail.parent = %s and detail.parenttype = 'Payroll Voucher' and detail.parentfield = 'salary_slips'
+		""", payroll_voucher, as_dict=True)[0]
+
+
+@frappe.whitelist()
+def update_salary_slip_rows(payroll_voucher, changes):
+	"""
+		Apply the form's edits to a paged salary slip table row by row instead of saving the whole voucher.
+		changes is {"added": [row], "updated": [row with name], "deleted": [row name]}, rows carrying only
+		EDITABLE_SALARY_SLIP_FIELDS. Returns the voucher's new modified timestamp, which the form keeps so its
+		next save is not mistaken for a stale one, and the new totals.
+	"""
+	if isinstance(changes, string_types):
+		changes = json.loads(changes)
+
+	frappe.has_permission("Payroll Voucher", "write", payroll_voucher, throw=True)
+	if frappe.db.get_value("Payroll Voucher", payroll_voucher, "docstatus") != 0:
+		frappe.throw(_("Salary slips can only be changed while {0} is a draft").format(payroll_voucher))
+
+	deleted = changes.get("deleted") or []
+	if deleted:
+		frappe.db.sql("""delete from `tabPayroll Salary Slip Detail`
+			where parent = %s and parenttype = 'Payroll Voucher' and name in %s""", (payroll_voucher, tuple(deleted)))
+
+	for row in changes.get("updated") or []:
+		values = get_salary_slip_row_values(row)
+		if values:
+			frappe.db.sql("""update `tabPayroll Salary Slip Detail` set {0}
+				where name = %(name)s and parent = %(parent)s and parenttype = 'Payroll Voucher'""".format(
+					", ".join("`{0}` = %({0})s".format(f) for f in values)),
+				dict(values, name=row.get("name"), parent=payroll_voucher))
+
+	added = changes.get("added") or []
+	if added:
+		idx = frappe.db.sql("""select ifnull(max(idx), 0) from `tabPayroll Salary Slip Detail`
+			where parent = %s and parenttype = 'Payroll Voucher'""", payroll_voucher)[0][0]
+		for row in added:
+			idx += 1
+			detail = frappe.new_doc("Payroll Salary Slip Detail")
+			detail.update(get_salary_slip_row_values(dict((f, row.get(f)) for f in EDITABLE_SALARY_SLIP_FIELDS)))
+			detail.update({"parent": payroll_voucher, "parenttype": "Payroll Voucher",
+				"parentfield": "salary_slips", "idx": idx})
+			detail.db_insert()
+
+	modified = now()
+	frappe.db.sql("""update `tabPayroll Voucher` set modified = %s, modified_by = %s where name = %s""",
+		(modified, frappe.session.user, payroll_voucher))
+
+	return {"modified": modified, "totals": get_salary_slip_totals(payroll_voucher)}
+
+
+def get_salary_slip_row_values(row):
+	"""
+		the editable fields the form sent for a row, with the employee name and the slip's dates that the
+		table copies from them filled in
+	"""
+	values = dict((f, row[f]) for f in EDITABLE_SALARY_SLIP_FIELDS if f in row)
+	if values.get("employee") and not values.get("employee_name"):
+		values["employee_name"] = frappe.db.get_value("Employee", values["employee"], "employee_name")
+	if "salary_slip" in values:
+		values["start_date"], values["end_date"] = values["salary_slip"] and frappe.db.get_value("Salary Slip",
+			values["salary_slip"], ["start_date", "end_date"]) or (None, None)
+	return values
+
+
+def load_salary_slip_rows(payroll_voucher):
+	"""
+		every salary slip row of a saved voucher, as stored
+	"""
+	return frappe.get_all("Payroll Salary Slip Detail", fields=["*"], order_by="idx",
+		filters={"parent": payroll_voucher, "parenttype": "Payroll Voucher", "parentfield": "salary_slips"})
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import add_days, getdate, nowdate
+
+from erpnext.hr.doctype.payroll_entry.payroll_entry import get_start_end_dates
+
+# once the current period ends within this many days, the next period's salary slips are drafted
+PREDRAFT_DAYS_BEFORE_PERIOD_END = 3
+
+
+def predraft_salary_slips():
+	"""
+		scheduler_events cron task, run in the off-peak window: for every company and payroll frequency whose
+		current period is about to close, queue the drafting of the next period's slips, one long job each.
+		Timesheet based slips are left to the voucher, since their pay comes from timesheets that may still be
+		logged until that period closes.
+	"""
+	today = nowdate()
+	for group in get_payroll_groups(today):
+		period = get_start_end_dates(group.payroll_frequency, today, group.company)
+		if getdate(period.end_date) > getdate(add_days(today, PREDRAFT_DAYS_BEFORE_PERIOD_END)):
+			continue
+
+		next_period = get_start_end_dates(group.payroll_frequency, add_days(period.end_date, 1), group.company)
+		frappe.enqueue(predraft_salary_slips_for, queue="long", timeout=7200,
+			company=group.company, payroll_frequency=group.payroll_frequency,
+			start_date=next_period.start_date, end_date=next_period.end_date)
+
+
+def get_payroll_groups(date):
+	"""
+		the (company, payroll frequency) combinations someone is paid under on the date, other than by timesheet
+	"""
+	return frappe.db.sql("""select distinct company, payroll_frequency
+		from `tabPayroll Eligibility`
+		where effective_from <= %(date)s and ifnull(effective_to, '2199-12-31') >= %(date)s
+			and ifnull(payroll_frequency, '') != '' and salary_slip_based_on_timesheet = 0""",
+		{"date": date}, as_dict=True)
+
+
+def predraft_salary_slips_for(company, payroll_frequency, start_date, end_date):
+	"""
+		Draft the missing salary slips of a period the way PayrollVoucher.create_salary_slips does, through a
+		voucher that is never saved: its table is populated from the eligibility index and the slips that already
+		exist, and the missing ones are drafted in bulk, with neither deduct_tax_* flag set. When HR creates the
+		voucher later, populating its table finds these drafts. Submitting a slip recomputes its components and
+		leave details, so attendance recorded in the meantime still counts; the submission chunks give each
+		draft the voucher's tax flags before submitting it (see submit_salary_slip_chunk).
+	"""
+	from oi_custom.customizations.doctype.payroll_voucher.payroll_voucher import \
+		create_salary_slips_for_employees_mod
+
+	voucher = frappe.get_doc({
+		"doctype": "Payroll Voucher",
+		"company": company,
+		"payroll_frequency": payroll_frequency,
+		"salary_slip_based_on_timesheet": 0,
+		"start_date": start_date,
+		"end_date": end_date,
+		"posting_date": end_date,
+		"cost_center": frappe.db.get_value("Company", company, "cost_center")
+	})
+	voucher.populate_salary_slip_table()
+
+	employees = [d.employee for d in voucher.salary_slips if not d.salary_slip]
+	if employees:
+		create_salary_slips_for_employees_mod(employees, voucher.salary_slips, voucher.get_salary_slip_args(),
+			publish_progress=False, commit=True)
+
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import time
+
+import frappe
+from frappe.utils import cint, cstr, flt, now, time_diff_in_seconds
+
+# realtime events the Payroll Voucher form listens to
+PROGRESS_EVENT = "payroll_job_progress"
+FINISHED_EVENT = "payroll_job_finished"
+
+# a job publishes at most once per PROGRESS_INTERVAL seconds, unless it moved PROGRESS_STEP percent or finished
+PROGRESS_INTERVAL = 0.5
+PROGRESS_STEP = 1
+
+# latest progress of every job, so a reloaded form sees more than the last committed chunk
+PROGRESS_CACHE_KEY = "payroll_job_progress"
+
+# a queued or running job that has not reported for this many seconds is taken to have died
+JOB_STALE_AFTER = 900
+
+# redis counters of the slips processed so far by all the workers of a job together
+PROGRESS_COUNTER_KEY = "payroll_job_done"
+
+
+class PayrollProgress(object):
+	"""
+		Throttled progress of a long payroll job. Call update() as often as work gets done, after every slip
+		if need be; it publishes to the voucher's form and records the progress in redis only when
+		PROGRESS_INTERVAL has passed or the job moved PROGRESS_STEP percent. The committed progress lives on
+		the Payroll Voucher Job itself and is written with each chunk.
+	"""
+	def __init__(self, payroll_voucher, title, total, done=0, job=None):
+		self.payroll_voucher = payroll_voucher
+		self.job = job
+		self.title = title
+		self.total = cint(total)
+		self.done = cint(done)
+		self.published_at = 0
+		self.published_progress = None
+
+	@property
+	def progress(self):
+		return flt(self.done * 100.0 / self.total, 1) if self.total else 100
+
+	def update(self, done=None, force=False):
+		if done is not None:
+			self.done = cint(done)
+
+		progress = self.progress
+		if not (force or progress >= 100 or self.published_progress is None
+			or progress - self.published_progress >= PROGRESS_STEP
+			or time.time() - self.published_at >= PROGRESS_INTERVAL):
+			return
+
+		self.published_at, self.published_progress = time.time(), progress
+		message = {
+			"payroll_voucher": self.payroll_voucher,
+			"job": self.job,
+			"title": self.title,
+			"progress": progress,
+			"done": self.done,
+			"total": self.total,
+			"updated": now()
+		}
+		if self.job:
+			frappe.cache().hset(PROGRESS_CACHE_KEY, self.job, message)
+		if self.payroll_voucher:
+			frappe.publish_realtime(PROGRESS_EVENT, message, doctype="Payroll Voucher", docname=self.payroll_voucher)
+
+
+def get_job_progress_columns(processed):
+	"""
+		SQL assignments that bring a Payroll Voucher Job's committed progress up to date, for the chunk updates
+	"""
+	return """progress = least(100, (ifnull(processed_slips, 0) + {0}) * 100 / greatest(ifnull(total_slips, 0), 1)),
+		progress_updated = '{1}'""".format(cint(processed), now())
+
+
+def count_job_progress(job, processed=1):
+	"""
+		add to the slips a job has processed and return the new total. Workers sharing a job finish their
+		chunks in any order, so they count on one shared counter rather than from where their chunk started.
+	"""
+	key = get_progress_counter_key(job)
+	done = frappe.cache().incr(key, processed)
+	frappe.cache().expire(key, JOB_STALE_AFTER)
+	return done
+
+
+def get_progress_counter_key(job):
+	return frappe.cache().make_key("{0}:{1}".format(PROGRESS_COUNTER_KEY, job))
+
+
+def clear_job_progress(job):
+	frappe.cache().hdel(PROGRESS_CACHE_KEY, job)
+	frappe.cache().delete(get_progress_counter_key(job))
+
+
+def publish_job_finished(payroll_voucher, job):
+	"""
+		tell the voucher's form that a job has ended, so that it reloads. Publish only after the job's last
+		commit, or the form reloads to what the job had before.
+	"""
+	status = frappe.db.get_value("Payroll Voucher Job", job, "status")
+	frappe.publish_realtime(FINISHED_EVENT, {"payroll_voucher": payroll_voucher, "job": job, "status": status},
+		doctype="Payroll Voucher", docname=payroll_voucher)
+
+
+def is_job_stale(job, live=None):
+	"""
+		whether a queued or running job has gone quiet for longer than JOB_STALE_AFTER, going by the later of
+		its last committed chunk and its last published progress
+	"""
+	live = live or frappe.cache().hget(PROGRESS_CACHE_KEY, job.name) or {}
+	last_seen = max(cstr(job.progress_updated or job.creation), cstr(live.get("updated")))
+	return time_diff_in_seconds(now(), last_seen) > JOB_STALE_AFTER
+
+
+def get_running_job(payroll_voucher, job_type):
+	"""
+		the voucher's job of this type that is queued or running and still reporting, if there is one
+	"""
+	for job in frappe.get_all("Payroll Voucher Job", fields=["name", "progress_updated", "creation"],
+		filters={"payroll_voucher": payroll_voucher, "job_type": job_type, "status": ("in", ("Queued", "Running"))}):
+		if not is_job_stale(job):
+			return job.name
+
+
+@frappe.whitelist()
+def get_payroll_jobs(payroll_voucher):
+	"""
+		The voucher's unfinished jobs, for its form: "running" lists the jobs still at work with their latest
+		progress, so the form can show it again after a reload; "resumable" holds, by job type, the jobs that
+		failed or stopped reporting and can be started again.
+	"""
+	frappe.has_permission("Payroll Voucher", "read", payroll_voucher, throw=True)
+
+	running, resumable = [], {}
+	for job in frappe.get_all("Payroll Voucher Job", fields=["name", "job_type", "status", "progress",
+			"processed_slips", "total_slips", "progress_updated", "creation"],
+		filters={"payroll_voucher": payroll_voucher, "status": ("not in", ("Completed", "Superseded"))},
+		order_by="creation"):
+		live = frappe.cache().hget(PROGRESS_CACHE_KEY, job.name) or {}
+		if job.status == "Failed" or is_job_stale(job, live):
+			resumable[job.job_type] = job.name
+			continue
+
+		running.append(frappe._dict({
+			"payroll_voucher": payroll_voucher,
+			"job": job.name,
+			"title": live.get("title") or job.job_type,
+			"progress": live.get("progress", flt(job.progress)),
+			"done": live.get("done", cint(job.processed_slips)),
+			"total": live.get("total", cint(job.total_slips))
+		}))
+
+	return {"running": running, "resumable": resumable}
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019, the Open Institute for Social Science and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cint, now
+
+from oi_custom.customizations.payroll import chunk_list
+from oi_custom.customizations.payroll.booking import get_salary_slips_booked_elsewhere
+from oi_custom.customizations.payroll.dispatch import SlipTimer, record_slip_timings
+from oi_custom.customizations.payroll.emailing import enqueue_salary_slip_emails
+from oi_custom.customizations.payroll.instrumentation import PayrollPhase, close_run_log
+from oi_custom.customizations.payroll.progress import PayrollProgress, get_job_progress_columns, clear_job_progress, \
+	count_job_progress, publish_job_finished
+
+# number of salary slips submitted (and committed) together by one background job
+SUBMISSION_CHUNK_SIZE = 100
+
+SUBMIT_JOB_TYPE = "Submit Salary Slips"
+
+# the voucher's tax choices, given to every draft it submits (predrafted slips are drafted without them)
+VOUCHER_TAX_FLAGS = ("deduct_tax_for_unclaimed_employee_benefits", "deduct_tax_for_unsubmitted_tax_exemption_proof")
+
+
+def get_unfinished_job(payroll_voucher, job_type):
+	"""
+		the Payroll Voucher Job of this type that has not completed yet, if there is one
+	"""
+	return frappe.db.get_value("Payroll Voucher Job",
+		{"payroll_voucher": payroll_voucher, "job_type": job_type, "status": ("not in", ("Completed", "Superseded"))})
+
+
+def plan_salary_slip_submission(payroll_voucher, salary_slips, chunk_size=SUBMISSION_CHUNK_SIZE):
+	"""
+		record the chunks still to be submitted for a voucher as a new job and return (job name, chunks). Only
+		slips that are still drafts are planned, so calling this again after an interruption picks up where the
+		last completed chunk left off. Every attempt gets a job of its own, and earlier unfinished ones are
+		superseded: workers still running chunks of those stop at their next chunk, and their counts can
+		never complete the new attempt.
+	"""
+	drafts = get_draft_salary_slips(salary_slips)
+	chunks = chunk_list(drafts, chunk_size)
+
+	frappe.db.sql("""update `tabPayroll Voucher Job` set status = 'Superseded'
+		where payroll_voucher = %s and job_type = %s and status in ('Queued', 'Running', 'Failed')""",
+		(payroll_voucher, SUBMIT_JOB_TYPE))
+
+	job = frappe.get_doc({
+		"doctype": "Payroll Voucher Job",
+		"payroll_voucher": payroll_voucher,
+		"job_type": SUBMIT_JOB_TYPE,
+		"status": "Queued",
+		"chunk_size": chunk_size,
+		"total_chunks": len(chunks),
+		"completed_chunks": 0,
+		"total_slips": len(drafts),
+		"processed_slips": 0,
+		"progress": 0,
+		"progress_updated": now()
+	})
+	job.flags.ignore_permissions = True
+	job.insert()
+
+	return job.name, chunks
+
+
+def get_draft_salary_slips(salary_slips):
+	"""
+		the slips, in the order given, that have not been submitted yet
+	"""
+	if not salary_slips:
+		return []
+
+	drafts = set(frappe.db.sql_list("""select name from `tabSalary Slip`
+		where docstatus = 0 and name in %(salary_slips)s""", {"salary_slips": tuple(salary_slips)}))
+	return [ss for ss in salary_slips if ss in drafts]
+
+
+def submit_salary_slip_chunk(job, salary_slips, commit=True, publish_progress=True):
+	"""
+		submit one chunk of salary slips and record it against the job. Several chunks of the same job can
+		run on different workers at once; whichever finishes last registers the voucher in the ledger. Chunks
+		of a job that a later attempt has superseded are left to that attempt. Each slip takes the voucher's
+		VOUCHER_TAX_FLAGS before it is submitted, and submitting recomputes its tax with them.
+	"""
+	frappe.flags.via_payroll_entry = True
+	submitted_ss = []
+	not_submitted_ss = []
+	payroll_voucher, status, total = frappe.db.get_value("Payroll Voucher Job", job,
+		["payroll_voucher", "status", "total_slips"])
+	if status == "Superseded":
+		return
+
+	progress = PayrollProgress(payroll_voucher, _("Submitting Salary Slips..."), total, job=job) \
+		if publish_progress else None
+
+	voucher_values = frappe.db.get_value("Payroll Voucher", payroll_voucher,
+		("payroll_frequency",) + VOUCHER_TAX_FLAGS, as_dict=True)
+	tax_flags = dict((f, cint(voucher_values.get(f))) for f in VOUCHER_TAX_FLAGS)
+
+	timer = SlipTimer()
+	try:
+		with PayrollPhase(payroll_voucher, "Submit"):
+			# one lookup per chunk for slips another voucher booked since this one was submitted
+			booked_elsewhere = get_salary_slips_booked_elsewhere(payroll_voucher, salary_slips)
+			for ss in salary_slips:
+				ss_obj = frappe.get_doc("Salary Slip", ss)
+				if ss_obj.docstatus != 0:
+					# already submitted by an earlier attempt at this chunk
+					continue
+
+				if ss_obj.net_pay<0 or ss_obj.name in booked_elsewhere:
+					not_submitted_ss.append(ss_obj.name)
+				else:
+					try:
+						start = time.time()
+						ss_obj.update(tax_flags)
+						ss_obj.submit()
+						timer.add(ss_obj.salary_structure, time.time() - start)
+						submitted_ss.append(ss_obj.name)
+					except frappe.ValidationError:
+						not_submitted_ss.append(ss_obj.name)
+
+				if progress:
+					progress.update(count_job_progress(job))
+
+		record_slip_timings("Submit", voucher_values.payroll_frequency, timer.timings)
+		frappe.db.sql("""update `tabPayroll Voucher Job`
+			set {progress},
+				completed_chunks = completed_chunks + 1,
+				processed_slips = processed_slips + %(processed)s,
+				submitted_slips = concat(ifnull(submitted_slips, ''), %(submitted)s),
+				failed_slips = concat(ifnull(failed_slips, ''), %(failed)s),
+				status = if(status = 'Queued', 'Running', status)
+			where name = %(job)s""".format(progress=get_job_progress_columns(len(salary_slips))), {
+				"job": job,
+				"processed": len(salary_slips),
+				"submitted": "".join(ss + "\n" for ss in submitted_ss),
+				"failed": "".join(ss + "\n" for ss in not_submitted_ss)
+			})
+		if commit:
+			frappe.db.commit()
+
+	except Exception:
+		if commit:
+			frappe.db.rollback()
+			mark_job_failed(job)
+		raise
+
+	if progress:
+		progress.update(force=True)
+
+	finish_salary_slip_submission(job, commit=commit)
+
+
+def submit_salary_slip_chunks(job, chunks, publish_progress=True):
+	"""
+		one worker's share of a submission: its chunks one after the other, each committed on its own
+	"""
+	for chunk in chunks:
+		submit_salary_slip_chunk(job, chunk, publish_progress=publish_progress)
+
+
+def finish_salary_slip_submission(job, commit=True):
+	"""
+		once every chunk of the job is in, register the voucher in the general ledger exactly once
+	"""
+	# lock the job row so that two chunks finishing together cannot both register the voucher
+	job_doc = frappe.db.sql("""select name, payroll_voucher, status, total_chunks, completed_chunks, failed_slips
+		from `tabPayroll Voucher Job` where name = %s for update""", job, as_dict=True)[0]
+	if job_doc.status in ("Completed", "Superseded") or cint(job_doc.completed_chunks) < cint(job_doc.total_chunks):
+		return
+
+	try:
+		payroll_entry = frappe.get_doc("Payroll Voucher", job_doc.payroll_voucher)
+		# every slip of the voucher submitted so far, including those of superseded attempts
+		submitted_ss = frappe.db.sql_list("""select name from `tabSalary Slip`
+			where payroll_voucher = %s and docstatus = 1""", payroll_entry.name)
+		not_submitted_ss = [ss for ss in (job_doc.failed_slips or "").split("\n") if ss]
+
+		if not payroll_entry.salary_slips_submitted:
+			if submitted_ss:
+				#payroll_entry.make_accrual_jv_entry()
+				payroll_entry.register_payroll_in_gl(cancel=False)
+				frappe.msgprint(_("Salary Slip submitted for period from {0} to {1}")
+					.format(payroll_entry.start_date, payroll_entry.end_date))
+
+				# rendered and sent by a background job; this only records what is to be sent
+				with PayrollPhase(payroll_entry.name, "Email"):
+					enqueue_salary_slip_emails(payroll_entry.name, submitted_ss)
+
+			payroll_entry.db_set("salary_slips_submitted", 1)
+			payroll_entry.notify_update()
+
+		if not submitted_ss and not not_submitted_ss:
+			frappe.msgprint(_("No salary slip found to submit for the above selected criteria"))
+
+		if not_submitted_ss:
+			frappe.msgprint(_("Could not submit some Salary Slips: {0}").format(", ".join(not_submitted_ss)))
+
+		frappe.db.set_value("Payroll Voucher Job", job, "status", "Completed")
+		clear_job_progress(job)
+		close_run_log(payroll_entry.name)
+		if commit:
+			frappe.db.commit()
+			publish_job_finished(job_doc.payroll_voucher, job)
+
+	except Exception:
+		if commit:
+			frappe.db.rollback()
+			mark_job_failed(job)
+			publish_job_finished(job_doc.payroll_voucher, job)
+		raise
+
+
+def mark_job_failed(job):
+	frappe.db.sql("""update `tabPayroll Voucher Job` set status = 'Failed', error = %s
+		where name = %s and status != 'Superseded'""", (frappe.get_traceback(), job))
+	frappe.db.commit()
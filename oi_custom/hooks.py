@@ -31,6 +31,7 @@ app_include_css = [
 
 # include js in doctype views
 # doctype_js = {"doctype" : "public/js/doctype.js"}
+doctype_js = {"Payment Entry" : "public/js/payment_entry.js"}
 # doctype_list_js = {"doctype" : "public/js/doctype_list.js"}
 # doctype_tree_js = {"doctype" : "public/js/doctype_tree.js"}
 # doctype_calendar_js = {"doctype" : "public/js/doctype_calendar.js"}
@@ -92,31 +93,68 @@ app_include_css = [
 # }
 
 doc_events = {
-	"Payment Entry": {
-		"before_validate":"oi_custom.customizations.overrides.custom_payment_entry.customize_before_validate",
+	"Currency Exchange": {
+		"on_update": "oi_custom.customizations.exchange_rates.clear_exchange_rate_cache",
+		"on_trash": "oi_custom.customizations.exchange_rates.clear_exchange_rate_cache",
+	},
+	"Employee": {
+		"on_update": [
+			"oi_custom.customizations.payroll.eligibility.update_employee_eligibility",
+			"oi_custom.customizations.payroll.discovery.clear_employee_discovery"
+		],
+		"on_trash": [
+			"oi_custom.customizations.payroll.eligibility.remove_employee_eligibility",
+			"oi_custom.customizations.payroll.discovery.clear_employee_discovery"
+		],
+		"after_rename": [
+			"oi_custom.customizations.payroll.eligibility.update_employee_eligibility",
+			"oi_custom.customizations.payroll.discovery.clear_employee_discovery"
+		],
+	},
+	"Salary Structure": {
+		"on_update": [
+			"oi_custom.customizations.payroll.eligibility.update_salary_structure_eligibility",
+			"oi_custom.customizations.payroll.discovery.clear_employee_discovery"
+		],
+		"on_submit": [
+			"oi_custom.customizations.payroll.eligibility.update_salary_structure_eligibility",
+			"oi_custom.customizations.payroll.discovery.clear_employee_discovery"
+		],
+		"on_cancel": [
+			"oi_custom.customizations.payroll.eligibility.update_salary_structure_eligibility",
+			"oi_custom.customizations.payroll.discovery.clear_employee_discovery"
+		],
+		"on_update_after_submit": [
+			"oi_custom.customizations.payroll.eligibility.update_salary_structure_eligibility",
+			"oi_custom.customizations.payroll.discovery.clear_employee_discovery"
+		],
+	},
+	"Salary Structure Assignment": {
+		"on_submit": [
+			"oi_custom.customizations.payroll.eligibility.update_employee_eligibility",
+			"oi_custom.customizations.payroll.discovery.clear_employee_discovery"
+		],
+		"on_cancel": [
+			"oi_custom.customizations.payroll.eligibility.update_employee_eligibility",
+			"oi_custom.customizations.payroll.discovery.clear_employee_discovery"
+		],
 	}
 }
 
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-# 	"all": [
-# 		"oi_custom.tasks.all"
-# 	],
-# 	"daily": [
-# 		"oi_custom.tasks.daily"
-# 	],
-# 	"hourly": [
-# 		"oi_custom.tasks.hourly"
-# 	],
-# 	"weekly": [
-# 		"oi_custom.tasks.weekly"
-# 	]
-# 	"monthly": [
-# 		"oi_custom.tasks.monthly"
-# 	]
-# }
+scheduler_events = {
+	"cron": {
+		# draft the salary slips of periods about to close at night, rather than when HR runs payroll
+		"30 1 * * *": [
+			"oi_custom.customizations.payroll.predrafting.predraft_salary_slips"
+		]
+	},
+	"hourly": [
+		"oi_custom.customizations.payroll.emailing.update_salary_slip_email_status"
+	]
+}
 
 # Testing
 # -------
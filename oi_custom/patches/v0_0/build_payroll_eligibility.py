@@ -0,0 +1,9 @@
+from __future__ import unicode_literals
+import frappe
+
+from oi_custom.customizations.payroll.eligibility import rebuild_payroll_eligibility
+
+
+def execute():
+	frappe.reload_doc("customizations", "doctype", "payroll_eligibility")
+	rebuild_payroll_eligibility()
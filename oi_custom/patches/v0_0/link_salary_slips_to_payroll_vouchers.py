@@ -0,0 +1,15 @@
+from __future__ import unicode_literals
+import frappe
+from frappe.modules.utils import sync_customizations
+
+
+def execute():
+	sync_customizations("oi_custom")
+
+	# slips booked by vouchers submitted before the link existed
+	frappe.db.sql("""update `tabSalary Slip` ss
+			inner join `tabPayroll Salary Slip Detail` detail on detail.salary_slip = ss.name
+				and detail.parenttype = 'Payroll Voucher'
+			inner join `tabPayroll Voucher` pv on pv.name = detail.parent
+		set ss.payroll_voucher = pv.name
+		where pv.docstatus = 1 and ss.docstatus != 2 and ifnull(ss.payroll_voucher, '') = ''""")
@@ -0,0 +1,65 @@
+// Copyright (c) 2019, the Open Institute for Social Science and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Payment Entry', {
+	refresh: function(frm) {
+		if (frm.doc.docstatus == 0 && in_list(["Customer", "Supplier"], frm.doc.party_type) && frm.doc.party) {
+			frm.add_custom_button(__("Load More Orders"), function() {
+				frm.events.load_orders_page(frm);
+			});
+		}
+	},
+	party: function(frm) {
+		frm.orders_cursor = null;
+		frm.all_orders_loaded = false;
+	},
+	load_orders_page: function(frm) {
+		// pages through the party's open orders; orders already in the references table are skipped
+		// the first page follows the orders the stock outstanding documents lookup already put in the table
+		if (frm.all_orders_loaded) {
+			frappe.show_alert(__("All open orders have been loaded"));
+			return;
+		}
+
+		var party_account_currency = frm.doc.payment_type == "Receive" ?
+			frm.doc.paid_from_account_currency : frm.doc.paid_to_account_currency;
+		var company_currency = frappe.get_doc(":Company", frm.doc.company).default_currency;
+
+		frappe.call({
+			method: 'oi_custom.customizations.overrides.custom_payment_entry.get_orders_to_be_billed_page',
+			args: {
+				posting_date: frm.doc.posting_date,
+				party_type: frm.doc.party_type,
+				party: frm.doc.party,
+				party_account_currency: party_account_currency,
+				company_currency: company_currency,
+				cost_center: frm.doc.cost_center,
+				cursor: frm.orders_cursor || null,
+				resume: frm.orders_cursor ? 0 : 1
+			},
+			callback: function(r) {
+				if (!r.message) return;
+
+				var existing = (frm.doc.references || []).map(function(d) { return d.reference_name; });
+				$.each(r.message.orders, function(i, d) {
+					if (in_list(existing, d.voucher_no)) return;
+
+					var c = frm.add_child("references");
+					c.reference_doctype = d.voucher_type;
+					c.reference_name = d.voucher_no;
+					c.total_amount = d.invoice_amount;
+					c.outstanding_amount = d.outstanding_amount;
+					c.exchange_rate = party_account_currency != company_currency ? d.exchange_rate : 1;
+				});
+				frm.refresh_field("references");
+
+				frm.orders_cursor = r.message.cursor;
+				if (!frm.orders_cursor) {
+					frm.all_orders_loaded = true;
+					frappe.show_alert(__("All open orders have been loaded"));
+				}
+			},
+			freeze: true
+		});
+	}
+});